@@ -1,7 +1,10 @@
+import os
+import json
+import math
 import numpy as np
 import random
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 
 class BaseFeature(object):
   """A single set of features of data."""
@@ -14,6 +17,7 @@ class BaseFeature(object):
 
 class ActionFeature(BaseFeature):
   """ A single set of features with precomputed context token ids"""
+  label_columns = {'label_id': (), 'action_id': ()}   # name to the shape of each row
   def __init__(self, input_ids, segment_ids, input_mask, label_ids, context):
     super().__init__(input_ids, segment_ids, input_mask, label_ids['value'])
     # token_ids is a batch_size length list, where each item is 100 ids
@@ -24,6 +28,8 @@ class ActionFeature(BaseFeature):
 
 class CompletionFeature(BaseFeature):
   """ A single set of completion features with precomputed context token ids"""
+  label_columns = {'intent_id': (), 'nextstep_id': (), 'action_id': (), 'value_id': (), 'utt_id': (),
+                   'candidates': (100,)}
   def __init__(self, input_ids, segment_ids, input_mask, label_ids, context, candidates):
     super().__init__(input_ids, segment_ids, input_mask, None)
     self.candidates = candidates
@@ -39,69 +45,191 @@ class CompletionFeature(BaseFeature):
 
 class CascadeFeature(CompletionFeature):
   """ A single set of completion features with precomputed context token ids"""
+  label_columns = dict(CompletionFeature.label_columns, convo_id=(), turn_count=())
   def __init__(self, input_ids, segment_ids, input_mask, label_ids, context, candidates):
     super().__init__(input_ids, segment_ids, input_mask, label_ids, context, candidates)
     self.convo_id = label_ids['convo']
     self.turn_count = label_ids['turn']
 
+class FeatureColumns(object):
+  """ Columnar storage for all the features of a single split.  Token sequences are kept
+  unpadded within one flat array per field, with offsets marking where each example starts,
+  while every label is a single array with one row per example.  The attention masks are
+  not stored at all since they follow directly from the sequence lengths. """
+  sequences = {'input_id': 'input', 'segment_id': 'input',
+               'context_token': 'context', 'context_segment': 'context'}
+  skipped = ['mask_id', 'context_mask', 'position_id']
+
+  def __init__(self, columns, pad_id, directory=None):
+    self.columns = columns
+    self.pad_id = pad_id
+    self.directory = directory
+
+  def __getstate__(self):
+    # memory mapped columns are re-opened by dataloader workers rather than copied over to them
+    if self.directory is None:
+      return self.__dict__
+    return {'pad_id': self.pad_id, 'directory': self.directory}
+
+  def __setstate__(self, state):
+    if 'columns' in state:
+      self.__dict__.update(state)
+    else:
+      self.__dict__.update(FeatureColumns.load(state['directory']).__dict__)
+
+  def __len__(self):
+    return len(self.columns['input_offsets']) - 1
+
+  def gather_sequences(self, group, indices, width=None):
+    """ Pads the token and segment ids of the given examples into a [batch_size, width] block
+    using a single vectorized lookup per column, where a width of None pads only up to the
+    longest example.  Returns the token ids, segment ids and attention mask as tensors. """
+    token_name, segment_name = ('input_id', 'segment_id') if group == 'input' \
+                                  else ('context_token', 'context_segment')
+    offsets = self.columns[f'{group}_offsets']
+    starts = offsets[indices]
+    lengths = offsets[indices + 1] - starts
+    width = int(lengths.max()) if width is None else width
+
+    steps = np.arange(width)
+    mask = steps[None, :] < lengths[:, None]
+    positions = np.where(mask, starts[:, None] + steps[None, :], 0)
+    token_ids = np.where(mask, self.columns[token_name][positions], self.pad_id)
+    segment_ids = np.where(mask, self.columns[segment_name][positions], 0)
+
+    return (torch.from_numpy(token_ids.astype(np.int64)), torch.from_numpy(segment_ids.astype(np.int64)),
+              torch.from_numpy(mask.astype(np.int64)))
+
+  @classmethod
+  def from_features(cls, features, vocab_size, pad_id, feature_class):
+    """ Every column of the feature_class is written even when there are no features, so that
+    an empty split still loads into a dataset of length zero """
+    # token ids fit into two bytes for all of the supported tokenizers
+    token_dtype = np.uint16 if vocab_size <= np.iinfo(np.uint16).max else np.int32
+    dtypes = {'input_id': token_dtype, 'context_token': token_dtype,
+              'segment_id': np.uint8, 'context_segment': np.uint8}
+    columns = {}
+
+    for group in ['input', 'context']:
+      sequence = 'input_id' if group == 'input' else 'context_token'
+      lengths = np.array([len(getattr(f, sequence)) for f in features], dtype=np.int64)
+      columns[f'{group}_offsets'] = np.concatenate([[0], np.cumsum(lengths)])
+
+    for name in cls.sequences:
+      flat = [tok for f in features for tok in getattr(f, name)]
+      columns[name] = np.array(flat, dtype=dtypes[name])
+    for name, shape in feature_class.label_columns.items():   # labels, ids and candidates
+      rows = [getattr(f, name) for f in features]
+      columns[name] = np.array(rows, dtype=np.int32).reshape((len(rows),) + shape)
+
+    return cls(columns, pad_id)
+
+  def save(self, directory):
+    os.makedirs(directory, exist_ok=True)
+    for name, column in self.columns.items():
+      np.save(os.path.join(directory, f'{name}.npy'), column)
+    manifest = {'pad_id': self.pad_id, 'num_examples': len(self),
+                'columns': {name: str(column.dtype) for name, column in self.columns.items()}}
+    json.dump(manifest, open(os.path.join(directory, 'manifest.json'), 'w'), indent=2)
+
+  @classmethod
+  def load(cls, directory):
+    # the arrays are memory mapped, so pages are only read from disk once they are accessed
+    manifest = json.load(open(os.path.join(directory, 'manifest.json'), 'r'))
+    columns = {}
+    for name in manifest['columns']:
+      columns[name] = np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r')
+    return cls(columns, manifest['pad_id'], directory)
+
+class BucketBatchSampler(Sampler):
+  """ Groups examples of similar length into the same batch so that little compute is spent on
+  padding.  When shuffling, the examples are randomly permuted and then sorted by length within
+  windows of bucket_size batches, after which the order of the batches is shuffled as well. """
+
+  def __init__(self, lengths, batch_size, shuffle, bucket_size=100, generator=None):
+    self.lengths = np.asarray(lengths)
+    self.batch_size = batch_size
+    self.shuffle = shuffle
+    self.generator = generator
+    num_examples = len(self.lengths)
+    self.window = batch_size * bucket_size if shuffle else max(num_examples, 1)
+
+  def __len__(self):
+    num_examples = len(self.lengths)
+    full_windows, remainder = divmod(num_examples, self.window)
+    batches_per_window = math.ceil(self.window / self.batch_size)
+    return full_windows * batches_per_window + math.ceil(remainder / self.batch_size)
+
+  def __iter__(self):
+    num_examples = len(self.lengths)
+    order = torch.randperm(num_examples, generator=self.generator).numpy() if self.shuffle \
+              else np.arange(num_examples)
+
+    batches = []
+    for start in range(0, num_examples, self.window):
+      bucket = order[start:start + self.window]
+      bucket = bucket[np.argsort(self.lengths[bucket], kind='stable')]
+      for position in range(0, len(bucket), self.batch_size):
+        batches.append(bucket[position:position + self.batch_size].tolist())
+
+    if self.shuffle:
+      shuffled = torch.randperm(len(batches), generator=self.generator).tolist()
+      batches = [batches[idx] for idx in shuffled]
+    yield from batches
+
 class BaseDataset(Dataset):
+  """ Holds the labels of a split as contiguous tensors and serves a whole batch at a time,
+  so it is indexed with the list of indices produced by a batch sampler rather than one
+  example at a time.  Token columns stay memory mapped until they are gathered. """
+  label_names = []
 
   def __init__(self, args, features):
     self.data = features
     self.model_type = args.model_type
     self.num_examples = len(features)
+    # the token columns are padded to the longest example in each batch, unless told otherwise
+    self.max_seq_len = args.max_seq_len if args.static_padding else None
+    self.max_context_len = 100 if args.static_padding else None  # hardcode limit of 100 context tokens
+    self.labels = self.stack_columns(self.label_names)
+
+  def stack_columns(self, names):
+    # one row per label, so that indexing a batch yields contiguous tensors for each label
+    columns = [np.asarray(self.data.columns[name], dtype=np.int64) for name in names]
+    return torch.from_numpy(np.stack(columns)) if columns else None
+
+  def lengths(self):
+    return np.diff(self.data.columns['input_offsets'])
 
   def __len__(self):
     return len(self.data)
 
-  def __getitem__(self, idx):
-    return self.data[idx]
-
-  def collate_func(self, args, split, raw_data):
-    raise NotImplementedError()
+  def __getitem__(self, indices):
+    indices = np.asarray(indices, dtype=np.int64)
+    history_batch = self.data.gather_sequences('input', indices, self.max_seq_len)
+    context_batch = self.data.gather_sequences('context', indices, self.max_context_len)
+    label_batch = tuple(self.labels[:, torch.from_numpy(indices)])
+    return history_batch + context_batch + label_batch
 
 class ActionDataset(BaseDataset):
+  label_names = ['action_id', 'label_id']   # value ids are held in the label_id of an ActionFeature
 
-  def collate_func(self, features):
-    input_ids = torch.tensor([f.input_id for f in features], dtype=torch.long)
-    segment_ids = torch.tensor([f.segment_id for f in features], dtype=torch.long)
-    mask_ids = torch.tensor([f.mask_id for f in features], dtype=torch.long)
-    context_tokens = torch.tensor([f.context_token for f in features], dtype=torch.long)
-    context_segments = torch.tensor([f.context_segment for f in features], dtype=torch.long)
-    context_masks = torch.tensor([f.context_mask for f in features], dtype=torch.long)
-    
-    action_ids = torch.tensor([f.action_id for f in features], dtype=torch.long)
-    value_ids = torch.tensor([f.label_id for f in features], dtype=torch.long)
+class CompletionDataset(BaseDataset):
+  label_names = ['intent_id', 'nextstep_id', 'action_id', 'value_id', 'utt_id']
 
-    return (input_ids, segment_ids, mask_ids, context_tokens, context_segments, context_masks,
-              action_ids, value_ids)
+  def __init__(self, args, features):
+    super().__init__(args, features)
+    self.candidates = torch.from_numpy(np.asarray(features.columns['candidates'], dtype=np.int64))
 
-class CompletionDataset(BaseDataset):
+  def __getitem__(self, indices):
+    batch = super().__getitem__(indices)
+    return batch + (self.candidates[torch.as_tensor(indices)],)
 
-  def collate_func(self, features):
-    input_ids = torch.tensor([f.input_id for f in features], dtype=torch.long)
-    segment_ids = torch.tensor([f.segment_id for f in features], dtype=torch.long)
-    mask_ids = torch.tensor([f.mask_id for f in features], dtype=torch.long)
-    context_tokens = torch.tensor([f.context_token for f in features], dtype=torch.long)
-    context_segments = torch.tensor([f.context_segment for f in features], dtype=torch.long)
-    context_masks = torch.tensor([f.context_mask for f in features], dtype=torch.long)
-    
-    intent_ids = torch.tensor([f.intent_id for f in features], dtype=torch.long)
-    nextstep_ids = torch.tensor([f.nextstep_id for f in features], dtype=torch.long)
-    action_ids = torch.tensor([f.action_id for f in features], dtype=torch.long)
-    value_ids = torch.tensor([f.value_id for f in features], dtype=torch.long)
-    utterance_ids = torch.tensor([f.utt_id for f in features], dtype=torch.long)
-    all_candidates = torch.tensor([f.candidates for f in features], dtype=torch.long)
-
-    return (input_ids, segment_ids, mask_ids, context_tokens, context_segments, context_masks,
-              intent_ids, nextstep_ids, action_ids, value_ids, utterance_ids, all_candidates)
-    
 class CascadeDataset(CompletionDataset):
 
-  def collate_func(self, features):
-    collated_batch = super().collate_func(features)
-    convo_ids = torch.tensor([f.convo_id for f in features], dtype=torch.long)
-    turn_counts = torch.tensor([f.turn_count for f in features], dtype=torch.long)
-    cascade_batch = (convo_ids, turn_counts)
+  def __init__(self, args, features):
+    super().__init__(args, features)
+    self.cascade = self.stack_columns(['convo_id', 'turn_count'])
 
-    return collated_batch + cascade_batch
+  def __getitem__(self, indices):
+    batch = super().__getitem__(indices)
+    return batch + tuple(self.cascade[:, torch.as_tensor(indices)])
@@ -11,6 +11,7 @@ from torch.nn import functional as F
 
 from transformers import BertModel, RobertaModel, AlbertModel
 from transformers.file_utils import WEIGHTS_NAME
+from components.retrieval import build_index
 
 class CoreModel(nn.Module):
   def __init__(self, args, checkpoint_dir):
@@ -25,10 +26,58 @@ class CoreModel(nn.Module):
     self.outputs = ['intent', 'nextstep', 'action', 'value', 'utt']
     self.checkpoint_dir = checkpoint_dir
     self.use_intent = args.use_intent
+    self.precision = args.precision
+    self.context_rows = args.context_rows
 
   def forward(self):
     raise NotImplementedError
 
+  def encode(self, inputs):
+    # only the encoder runs under autocast, so the heads, softmaxes and losses all stay in fp32
+    device_type = inputs['input_ids'].device.type
+    dtype = torch.float16 if self.precision == 'fp16' else torch.bfloat16
+    with torch.autocast(device_type=device_type, dtype=dtype, enabled=self.precision != 'fp32'):
+      outputs = self.encoder(**inputs)
+    return outputs.pooler_output.float()
+
+  def select_value_rows(self, context_tokens):
+    """ Rows which need their values filled in.  The context of every other row is just the
+    [CLS] and [SEP] tokens, so those rows can skip the context encoder entirely.  Returns
+    None when every row should be encoded. """
+    if self.context_rows == 'all':
+      return None
+    return context_tokens['attention_mask'].sum(dim=1) > 2
+
+  def score_values(self, enum_prob, context_tokens, value_rows=None):
+    # value_rows is a boolean mask of the rows to encode, rows which are skipped fall back
+    # to the enumerable values alone, which is the same as a gate fully open to the enum_prob
+    batch_size = enum_prob.shape[0]
+    if value_rows is not None:
+      rows = value_rows.nonzero(as_tuple=True)[0]
+      width = int(context_tokens['attention_mask'][rows].sum(dim=1).max()) if len(rows) > 0 else 0
+      context_tokens = {name: tensor[rows, :width] for name, tensor in context_tokens.items()}
+
+    if value_rows is None or len(rows) > 0:
+      pooled_context = self.encode(context_tokens)                    # num_rows x hidden
+      copy_prob = self.softmax(self.copy_projection(pooled_context))  # num_rows x 100
+      reverse_copy_proj = self.copy_projection.weight.t()             # hidden x 100
+      copy_context = torch.matmul(pooled_context, reverse_copy_proj)  # num_rows x 100
+      joined = torch.cat([pooled_context, copy_context], dim=1)       # num_rows x 768+100
+      gate = self.sigmoid(self.gating_mechanism(joined))              # num_rows x 1
+
+    if value_rows is not None:   # scatter the encoded rows back into place
+      full_gate = enum_prob.new_ones(batch_size, 1)
+      full_copy = enum_prob.new_zeros(batch_size, self.copy_projection.out_features)
+      if len(rows) > 0:
+        full_gate = full_gate.index_copy(0, rows, gate)
+        full_copy = full_copy.index_copy(0, rows, copy_prob)
+      gate, copy_prob = full_gate, full_copy
+
+    enum_score = gate * enum_prob                                   # batch_size x num_values
+    copy_score = (1-gate) * copy_prob                               # batch_size x 100
+    value_score = torch.cat([enum_score, copy_score], dim=1)        # batch_size x num_values+100
+    return value_score
+
   def save_pretrained(self, filepath=None):
     if filepath is None:
       filepath = os.path.join(self.checkpoint_dir, 'pytorch_model.pt')
@@ -36,13 +85,14 @@ class CoreModel(nn.Module):
     print(f"Model weights saved in {filepath}")
 
   @classmethod
-  def from_pretrained(cls, hidden_dim, ontology_size, base_model, device, filepath=None):
-    # Instantiate model.
-    model = cls(hidden_dim, ontology_size, base_model, device)
+  def from_pretrained(cls, args, mappers, checkpoint_dir, vocab_size, filepath=None):
+    # Instantiate model, with room in the embeddings for the special tokens added by the tokenizer
+    model = cls(args, mappers, checkpoint_dir)
+    model.encoder.resize_token_embeddings(vocab_size)
     # Load weights and fill them inside the model
     if filepath is None:
-      filepath = os.path.join(self.checkpoint_dir, 'pytorch_model.pt')
-    model.load_state_dict(torch.load(filepath))
+      filepath = os.path.join(checkpoint_dir, 'pytorch_model.pt')
+    model.load_state_dict(torch.load(filepath, map_location='cpu'))
     model.eval()
     print(f"Model loaded from {filepath}")
     return model
@@ -75,22 +125,12 @@ class ActionStateTracking(CoreModel):
     self.sigmoid = nn.Sigmoid()
 
   def forward(self, full_history, context_tokens):
-    history_outputs = self.encoder(**full_history)                
-    pooled_history = history_outputs.pooler_output                  # batch_size x 768
+    pooled_history = self.encode(full_history)                      # batch_size x 768
     action_score = self.softmax(self.action_projection(pooled_history))
     enum_prob = self.softmax(self.enum_projection(pooled_history))
 
-    context_outputs = self.encoder(**context_tokens)               
-    pooled_context = context_outputs.pooler_output                  # batch_size x hidden
-    copy_prob = self.softmax(self.copy_projection(pooled_context))  # batch_size x 100
-    reverse_copy_proj = self.copy_projection.weight.t()             # hidden x 100
-    copy_context = torch.matmul(pooled_context, reverse_copy_proj)  # batch_size x 100
-    joined = torch.cat([pooled_context, copy_context], dim=1)       # batch_size x 768+100
-    gate = self.sigmoid(self.gating_mechanism(joined))              # batch_size x 1
-
-    enum_score = gate * enum_prob                                   # batch_size x 126
-    copy_score = (1-gate) * copy_prob                               # batch_size x 100
-    value_score = torch.cat([enum_score, copy_score], dim=1)        # batch_size x 226
+    value_rows = self.select_value_rows(context_tokens)
+    value_score = self.score_values(enum_prob, context_tokens, value_rows)  # batch_size x 226
 
     return action_score, value_score
 
@@ -114,10 +154,79 @@ class CascadeDialogSuccess(CoreModel):
 
     self.softmax = nn.Softmax(dim=1)
     self.sigmoid = nn.Sigmoid()
+    self.projected_bank, self.bank_version = None, None
+    self.index, self.index_version = None, None
+    self.index_type = args.index_type
+    self.index_options = {'num_lists': args.num_lists, 'num_probe': args.num_probe,
+                          'num_subspaces': args.pq_subspaces, 'seed': args.seed}
 
   def add_candidate_data(self, utt_texts, utt_vectors):
     self.utt_texts = utt_texts
-    self.utt_vectors = utt_vectors
+    # held on the same device as the model and moved along with it, but left out of checkpoints
+    device = next(self.parameters()).device
+    self.register_buffer('utt_vectors', utt_vectors.to(device), persistent=False)
+    self.projected_bank, self.bank_version = None, None
+    self.index, self.index_version = None, None
+
+  def project_bank(self):
+    """ Applies the candidate_linear to the entire utterance bank once and caches the result.
+    Optimizer steps and loading weights both modify the parameters in place, which bumps
+    their version counters, while moving devices changes the storage, so either one causes
+    the bank to be projected again on the next call. """
+    weight, bias = self.candidate_linear.weight, self.candidate_linear.bias
+    version = (weight._version, bias._version, weight.data_ptr(), self.utt_vectors.data_ptr())
+    if self.projected_bank is None or version != self.bank_version:
+      with torch.no_grad():
+        self.projected_bank = self.candidate_linear(self.utt_vectors)   # (num_utterances, 128)
+      self.bank_version = version
+    return self.projected_bank
+
+  def build_index(self):
+    # the index is built over the projected bank, so it goes stale whenever the bank does
+    bank = self.project_bank()
+    if self.index is None or self.index_version != self.bank_version:
+      options = self.index_options if self.index_type == 'ivfpq' else {}
+      self.index = build_index(bank.cpu().numpy(), self.index_type, **options)
+      self.index_version = self.bank_version
+    return self.index
+
+  def retrieve(self, full_history, k=10):
+    """ Ranks the entire utterance bank rather than the candidates sampled for each turn.
+    Returns the scores and ids of the k best utterances for each history, where the scores
+    are the same dot products that the forward pass normalizes over its candidates. """
+    with torch.no_grad():
+      pooled_history = self.encode(full_history)              # batch_size x 768
+      projected_history = self.context_linear(pooled_history) # batch_size x 128
+    scores, utt_ids = self.build_index().search(projected_history.cpu().numpy(), k)
+    return torch.from_numpy(scores), torch.from_numpy(utt_ids)
+
+  def predict(self, full_history, context_tokens, k=1):
+    """ Scores live turns, which unlike the dataset have no sampled candidates, so utterances
+    are instead retrieved from the full bank.  A single encoder pass over the histories feeds
+    every head, along with one more over the contexts of rows which may need a value. """
+    with torch.no_grad():
+      pooled_history = self.encode(full_history)                  # batch_size x 768
+      intent_score = self.softmax(self.intent_projection(pooled_history))
+      nextstep_score = self.softmax(self.nextstep_projection(pooled_history))
+      action_score = self.softmax(self.action_projection(pooled_history))
+      enum_prob = self.softmax(self.enum_projection(pooled_history))
+      projected_history = self.context_linear(pooled_history)     # batch_size x 128
+
+      value_rows = self.select_value_rows(context_tokens)
+      if value_rows is not None and self.context_rows == 'predicted':
+        take_action = self.mappings['nextstep']['take_action']
+        value_rows = value_rows & (nextstep_score.argmax(dim=1) == take_action)
+      value_score = self.score_values(enum_prob, context_tokens, value_rows)
+
+    utt_scores, utt_ids = self.build_index().search(projected_history.cpu().numpy(), k)
+    utt_score = (torch.from_numpy(utt_scores), torch.from_numpy(utt_ids))
+    return intent_score, nextstep_score, action_score, value_score, utt_score
+
+  def train(self, mode=True):
+    if mode:  # the caches are only used during inference, so free them up while training
+      self.projected_bank, self.bank_version = None, None
+      self.index, self.index_version = None, None
+    return super().train(mode)
 
   def forward(self, full_history, context_tokens, tools):
     if self.use_intent:
@@ -125,8 +234,7 @@ class CascadeDialogSuccess(CoreModel):
     else:
       all_candidates, device = tools
 
-    history_outputs = self.encoder(**full_history)                # batch_size x 768
-    pooled_history = history_outputs.pooler_output
+    pooled_history = self.encode(full_history)                  # batch_size x 768
     intent_score = self.softmax(self.intent_projection(pooled_history))
     nextstep_score = self.softmax(self.nextstep_projection(pooled_history))
     action_score = self.softmax(self.action_projection(pooled_history))
@@ -135,29 +243,26 @@ class CascadeDialogSuccess(CoreModel):
     encoded_history = pooled_history.unsqueeze(1)               # (batch_size, 1, hidden_dim)
     projected_history = self.context_linear(encoded_history)    # (batch_size, 1, 128)
 
-    batch_cands = []
-    for row in all_candidates:                            # each row includes 100 positions
-      vectors = [self.utt_vectors[position] for position in row]
-      batch_cands.append(torch.stack(vectors))             
-
-    candidates = torch.stack(batch_cands).to(device)      # batch_size, num_candidates, hidden_dim
-    candidates = self.candidate_linear(candidates)        # (batch_size, num_candidates, 128)
+    # padded candidate positions hold -1, so they point at a valid row and are masked out after
+    candidate_mask = all_candidates >= 0                  # (batch_size, num_candidates)
+    if torch.is_grad_enabled():
+      candidates = self.utt_vectors[all_candidates.clamp(min=0)]  # batch_size, num_candidates, hidden_dim
+      candidates = self.candidate_linear(candidates)      # (batch_size, num_candidates, 128)
+    else:   # the weights are frozen, so just look up the rows of the projected bank
+      candidates = self.project_bank()[all_candidates.clamp(min=0)]
     candidates = candidates.transpose(1,2)                # (batch_size, 128, num_candidates)
 
     utt_score = torch.bmm(projected_history, candidates)
     utt_score = utt_score.squeeze(1)                      # (batch_size, num_candidates)
+    # rows without any candidates, such as take_action turns, come out as a uniform distribution
+    utt_score = utt_score.masked_fill(~candidate_mask, torch.finfo(utt_score.dtype).min)
     utt_score = self.softmax(utt_score)                   # normalize into probabilities
 
-    context_outputs = self.encoder(**context_tokens)               
-    pooled_context = context_outputs.pooler_output
-    copy_prob = self.softmax(self.copy_projection(pooled_context))  # batch_size x 100
-    reverse_copy_proj = self.copy_projection.weight.t()
-    copy_context = torch.matmul(pooled_context, reverse_copy_proj)  # batch_size x hidden
-    joined = torch.cat([pooled_context, copy_context], dim=1)       # batch_size x 768+100
-    gate = self.sigmoid(self.gating_mechanism(joined))              # batch_size x 1
-
-    enum_score = gate * enum_prob                                   # batch_size x 125
-    copy_score = (1-gate) * copy_prob                               # batch_size x 100
-    value_score = torch.cat([enum_score, copy_score], dim=1)        # batch_size x 225
+    value_rows = self.select_value_rows(context_tokens)
+    if value_rows is not None and self.context_rows == 'predicted' and not torch.is_grad_enabled():
+      # at inference time, only the turns where the model chooses to take an action need values
+      take_action = self.mappings['nextstep']['take_action']
+      value_rows = value_rows & (nextstep_score.argmax(dim=1) == take_action)
+    value_score = self.score_values(enum_prob, context_tokens, value_rows)  # batch_size x 225
 
     return intent_score, nextstep_score, action_score, value_score, utt_score
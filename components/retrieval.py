@@ -0,0 +1,143 @@
+import os, sys, pdb
+import math
+import numpy as np
+
+""" Top-k inner product search over the full utterance bank.  The ExactIndex scores every
+utterance, one block of the bank at a time, while the IVFPQIndex only visits the few clusters
+closest to the query and scores their members from compressed codes.  Both share the same
+search interface, returning scores and utterance ids sorted from best to worst. """
+
+def top_k(scores, ids, k):
+  # keeps the k highest scores of every row, sorted in descending order
+  if scores.shape[1] > k:
+    keep = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    scores = np.take_along_axis(scores, keep, axis=1)
+    ids = np.take_along_axis(ids, keep, axis=1)
+  order = np.argsort(-scores, axis=1, kind='stable')
+  return np.take_along_axis(scores, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+def nearest_centroids(data, centroids, block_size=8192):
+  # argmin of the squared distance, which drops the |x|^2 term since it is the same for every centroid
+  half_norms = 0.5 * (centroids ** 2).sum(axis=1)
+  assignments = np.empty(len(data), dtype=np.int64)
+  for start in range(0, len(data), block_size):
+    similarity = data[start:start + block_size] @ centroids.T - half_norms
+    assignments[start:start + block_size] = similarity.argmax(axis=1)
+  return assignments
+
+def kmeans(data, num_clusters, iterations, rng):
+  centroids = data[rng.choice(len(data), num_clusters, replace=False)].copy()
+  for _ in range(iterations):
+    assignments = nearest_centroids(data, centroids)
+    sums = np.zeros_like(centroids)
+    np.add.at(sums, assignments, data)
+    counts = np.bincount(assignments, minlength=num_clusters)
+    filled = counts > 0   # empty clusters keep their previous centroid
+    centroids[filled] = sums[filled] / counts[filled, None]
+  return centroids, nearest_centroids(data, centroids)
+
+class ExactIndex(object):
+  """ Brute force search, which is blocked so that the score matrix never grows beyond
+  num_queries x block_size no matter how large the bank becomes """
+  def __init__(self, vectors, block_size=8192):
+    self.vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    self.block_size = block_size
+
+  def __len__(self):
+    return len(self.vectors)
+
+  def search(self, queries, k):
+    queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+    k = min(k, len(self))
+    best_scores = np.empty((len(queries), 0), dtype=np.float32)
+    best_ids = np.empty((len(queries), 0), dtype=np.int64)
+
+    for start in range(0, len(self), self.block_size):
+      block = self.vectors[start:start + self.block_size]
+      block_ids = np.broadcast_to(np.arange(start, start + len(block)), (len(queries), len(block)))
+      scores = np.concatenate([best_scores, queries @ block.T], axis=1)
+      ids = np.concatenate([best_ids, block_ids], axis=1)
+      best_scores, best_ids = top_k(scores, ids, k)
+    return best_scores, best_ids
+
+class IVFPQIndex(object):
+  """ Inverted file index with product quantization.  The bank is clustered into num_lists
+  coarse clusters, and the residual of each vector from its centroid is split into
+  num_subspaces chunks which are each stored as a one byte code.  A query visits only the
+  num_probe clusters with the highest centroid scores, and scores their members with
+  a lookup table per subspace.  The best k * rerank of those are then rescored exactly, so
+  the approximation only decides which utterances are considered, not their final order. """
+
+  def __init__(self, vectors, num_lists=None, num_subspaces=16, num_codes=256, num_probe=8,
+                  rerank=4, iterations=20, seed=14):
+    self.vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    num_vectors, hidden_dim = self.vectors.shape
+    if hidden_dim % num_subspaces != 0:
+      raise ValueError(f"hidden dim of {hidden_dim} cannot be split into {num_subspaces} subspaces")
+    rng = np.random.RandomState(seed)
+
+    self.num_lists = min(num_lists or int(math.sqrt(num_vectors)), num_vectors)
+    self.num_subspaces = num_subspaces
+    self.subspace_dim = hidden_dim // num_subspaces
+    self.num_probe = num_probe
+    self.rerank = rerank
+
+    self.centroids, assignments = kmeans(self.vectors, self.num_lists, iterations, rng)
+    residuals = self.vectors - self.centroids[assignments]
+
+    num_codes = min(num_codes, 256, num_vectors)   # codes are stored in a single byte
+    self.codebooks = np.empty((num_subspaces, num_codes, self.subspace_dim), dtype=np.float32)
+    codes = np.empty((num_vectors, num_subspaces), dtype=np.uint8)
+    for sub in range(num_subspaces):
+      chunk = residuals[:, sub * self.subspace_dim:(sub + 1) * self.subspace_dim]
+      self.codebooks[sub], codes[:, sub] = kmeans(np.ascontiguousarray(chunk), num_codes, iterations, rng)
+
+    # members of each list are stored contiguously, with offsets marking where each list starts
+    order = np.argsort(assignments, kind='stable')
+    self.list_ids = order
+    self.list_codes = codes[order]
+    counts = np.bincount(assignments, minlength=self.num_lists)
+    self.list_offsets = np.concatenate([[0], np.cumsum(counts)])
+
+  def __len__(self):
+    return len(self.vectors)
+
+  def search(self, queries, k, num_probe=None):
+    queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+    num_probe = min(num_probe or self.num_probe, self.num_lists)
+    k = min(k, len(self))
+    scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+    ids = np.full((len(queries), k), -1, dtype=np.int64)
+
+    coarse_scores = queries @ self.centroids.T                       # num_queries x num_lists
+    probed = np.argpartition(-coarse_scores, num_probe - 1, axis=1)[:, :num_probe]
+    subspaces = np.arange(self.num_subspaces)
+
+    for row, query in enumerate(queries):
+      # score of every code within every subspace, summed over subspaces to score a residual
+      chunks = query.reshape(self.num_subspaces, 1, self.subspace_dim)
+      table = (chunks * self.codebooks).sum(axis=2)                  # num_subspaces x num_codes
+
+      candidate_ids, candidate_scores = [], []
+      for cluster in probed[row]:
+        start, stop = self.list_offsets[cluster], self.list_offsets[cluster + 1]
+        residual_scores = table[subspaces, self.list_codes[start:stop]].sum(axis=1)
+        candidate_ids.append(self.list_ids[start:stop])
+        candidate_scores.append(coarse_scores[row, cluster] + residual_scores)
+      candidate_ids = np.concatenate(candidate_ids)[None, :]
+      candidate_scores = np.concatenate(candidate_scores)[None, :]
+
+      if self.rerank > 0:
+        shortlist = top_k(candidate_scores, candidate_ids, k * self.rerank)[1]
+        candidate_ids, candidate_scores = shortlist, (self.vectors[shortlist[0]] @ query)[None, :]
+      found_scores, found_ids = top_k(candidate_scores, candidate_ids, k)
+      scores[row, :found_ids.shape[1]] = found_scores[0]
+      ids[row, :found_ids.shape[1]] = found_ids[0]
+    return scores, ids
+
+def build_index(vectors, index_type='exact', **options):
+  if index_type == 'exact':
+    return ExactIndex(vectors)
+  elif index_type == 'ivfpq':
+    return IVFPQIndex(vectors, **options)
+  raise ValueError(f"Unknown index type {index_type}")
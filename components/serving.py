@@ -0,0 +1,353 @@
+import os, sys, pdb
+import json
+import time
+import asyncio
+import numpy as np
+
+from array import array
+from collections import Counter, OrderedDict, deque
+from utils.process import DialogueHistory
+
+class ServingStats(object):
+  """ Latency of each turn, from arriving in the queue to its response being ready, along with
+  a histogram of how many turns were answered by each batched pass of the model """
+  def __init__(self, window=10000):
+    self.latencies = deque(maxlen=window)   # seconds, only the most recent turns are kept
+    self.batch_sizes = Counter()
+    self.num_turns = 0
+
+  def record_batch(self, latencies):
+    self.latencies.extend(latencies)
+    self.batch_sizes[len(latencies)] += 1
+    self.num_turns += len(latencies)
+
+  def summary(self):
+    latencies = np.array(self.latencies) * 1000
+    num_batches = sum(self.batch_sizes.values())
+    return {'turns': self.num_turns, 'batches': num_batches,
+      'p50_ms': round(float(np.percentile(latencies, 50)), 2) if len(latencies) > 0 else None,
+      'p99_ms': round(float(np.percentile(latencies, 99)), 2) if len(latencies) > 0 else None,
+      'mean_batch_size': round(self.num_turns / num_batches, 2) if num_batches > 0 else None,
+      'batch_sizes': {str(size): count for size, count in sorted(self.batch_sizes.items())}}
+
+class SessionHistory(DialogueHistory):
+  """ The DialogueHistory of a live session, kept to a small and predictable size.  Token ids
+  are packed as two byte integers and stop growing at the model's effective window just like
+  the history they feed, and utterance text is dropped as soon as it has been tokenized.  Only
+  the most recent candidate tokens which could still fall within the copy window are kept,
+  while candidate_index still remembers every token seen so that one which reappears keeps its
+  first position, just as in training. """
+
+  def __init__(self, processor, window=100):
+    super().__init__(processor)
+    self.token_ids = array('H' if len(processor.tokenizer) <= 1 << 16 else 'i')
+    self.window = window
+    self.num_utterances = 0
+    self.first_is_empty = False
+    self.scene, self.action_taken = None, False
+    self.last_active = time.monotonic()
+    self.lock = asyncio.Lock()    # held while one of its turns is in flight
+    self.pending = 0              # turns which have been submitted but not yet answered
+    self.ended = False            # removed from the store once its pending turns are answered
+
+  def __len__(self):
+    return self.num_utterances
+
+  def append(self, utterance):
+    self.num_utterances += 1
+    text = utterance.split('|')[1]
+    if self.num_utterances == 1:
+      self.first_is_empty = text == ''
+    self.encode(utterance, add_separator=self.num_utterances > 1)
+
+    self.index_candidates(text)
+    if len(self.candidate_tokens) > self.window:
+      self.candidate_tokens = self.candidate_tokens[-self.window:]
+
+  def set_intent(self, intent):
+    # without --use-intent the intent is not part of the encoding, so nothing is encoded again
+    self.intent = intent
+
+  def candidate_window(self, size):
+    # positions count every token ever indexed, including those trimmed from the front
+    num_dropped = len(self.candidate_index) - len(self.candidate_tokens)
+    start = max(len(self.candidate_index) - size, 0)
+    return self.candidate_tokens[max(start - num_dropped, 0):], start
+
+  def embed(self):
+    is_empty = self.num_utterances == 0 or (self.num_utterances == 1
+                and not self.processor.use_intent and self.first_is_empty)
+    if is_empty:  # an empty history is represented with a single padding token
+      return self.processor.embed_utterance('', pad=False)
+    return self.processor.embed_token_ids(self.token_ids.tolist(), pad=False)
+
+  @property
+  def busy(self):
+    return self.pending > 0
+
+  def to_state(self):
+    return {'token_ids': self.token_ids.tolist(), 'seen_tokens': list(self.candidate_index),
+            'num_utterances': self.num_utterances, 'first_is_empty': self.first_is_empty,
+            'scene': self.scene, 'action_taken': self.action_taken,
+            'idle': time.monotonic() - self.last_active}
+
+  @classmethod
+  def from_state(cls, processor, state, window=100):
+    session = cls(processor, window)
+    session.token_ids.extend(state['token_ids'])
+    session.candidate_index = {tok: position for position, tok in enumerate(state['seen_tokens'])}
+    session.candidate_tokens = state['seen_tokens'][-window:]
+    session.num_utterances, session.first_is_empty = state['num_utterances'], state['first_is_empty']
+    session.scene, session.action_taken = state['scene'], state['action_taken']
+    session.last_active = time.monotonic() - state['idle']
+    return session
+
+class SessionStore(object):
+  """ Holds the live sessions in order of when they were last used.  Once there are more than
+  max_sessions, the least recently used are evicted, as is any session left idle for longer
+  than ttl seconds.  Sessions with a turn pending are never evicted, and ending one only takes
+  effect once its pending turns are answered.  The whole store can be saved to disk and
+  restored, for example across restarts of the server.  Models trained with --use-intent
+  prefix every utterance with the intent, which is not known for live turns, so they are
+  rejected rather than served with histories encoded without it. """
+
+  def __init__(self, processor, max_sessions=10000, ttl=1800, window=100):
+    if processor.use_intent:
+      raise ValueError("Models trained with --use-intent need the intent of each turn, so they cannot be served")
+    self.processor = processor
+    self.max_sessions = max_sessions
+    self.ttl = ttl
+    self.window = window
+    self.sessions = OrderedDict()
+    self.num_evicted = 0
+
+  def __len__(self):
+    return len(self.sessions)
+
+  def __contains__(self, session_id):
+    return session_id in self.sessions
+
+  def get(self, session_id):
+    # fetches the session, starting a new one if needed, and marks it as the most recently used
+    if session_id in self.sessions:
+      self.sessions.move_to_end(session_id)
+    else:
+      self.sessions[session_id] = SessionHistory(self.processor, self.window)
+    session = self.sessions[session_id]
+    session.last_active = time.monotonic()
+    self.evict(keep=session_id)
+    return session
+
+  def checkout(self, session_id):
+    # marks a turn of the session as pending, which keeps it in the store until it is released
+    session = self.get(session_id)
+    session.pending += 1
+    return session
+
+  def release(self, session_id, session):
+    session.pending -= 1
+    session.last_active = time.monotonic()
+    if session.ended and not session.busy and self.sessions.get(session_id) is session:
+      del self.sessions[session_id]
+
+  def pop(self, session_id):
+    session = self.sessions.get(session_id)
+    if session is not None and session.busy:
+      session.ended = True    # removed by release once its last pending turn is answered
+    elif session is not None:
+      del self.sessions[session_id]
+    return session
+
+  def evict(self, keep=None):
+    now = time.monotonic()
+    for session_id in list(self.sessions.keys()):
+      session = self.sessions[session_id]
+      over_capacity = len(self.sessions) > self.max_sessions
+      if not over_capacity and now - session.last_active <= self.ttl:
+        break   # sessions are ordered by last use, so the rest are newer still
+      if session_id != keep and not session.busy:
+        del self.sessions[session_id]
+        self.num_evicted += 1
+
+  def snapshot(self, path):
+    states = {session_id: session.to_state() for session_id, session in self.sessions.items()
+                if not session.ended}
+    json.dump(states, open(path + '.tmp', 'w'))
+    os.replace(path + '.tmp', path)   # a crash mid write leaves the previous snapshot intact
+
+  def restore(self, path):
+    states = json.load(open(path, 'r'))
+    for session_id, state in states.items():   # saved from least to most recently used
+      self.sessions[session_id] = SessionHistory.from_state(self.processor, state, self.window)
+    self.evict()
+    return len(self.sessions)
+
+class MicroBatcher(object):
+  """ Coalesces the turns of many concurrent conversations into micro batches.  A batch is sent
+  to the model once it holds max_batch_size turns or its oldest turn has waited max_delay
+  seconds, whichever comes first.  The model runs on a worker thread so that new turns keep
+  being queued while a batch is in flight, and each session only has one turn in flight at a
+  time so its replies come back in order. """
+
+  def __init__(self, app, sessions, max_batch_size=32, max_delay=0.01):
+    self.app = app
+    self.sessions = sessions    # a SessionStore
+    self.max_batch_size = max_batch_size
+    self.max_delay = max_delay
+    self.stats = ServingStats()
+    self.queue, self.worker = None, None
+
+  def start(self):
+    self.queue = asyncio.Queue()
+    self.worker = asyncio.get_running_loop().create_task(self.run())
+
+  async def stop(self):
+    self.worker.cancel()
+    try:
+      await self.worker
+    except asyncio.CancelledError:
+      pass
+
+  def end_session(self, session_id):
+    self.sessions.pop(session_id)
+
+  async def submit(self, session_id, text, speaker='customer'):
+    history = self.sessions.checkout(session_id)
+    try:
+      async with history.lock:
+        history.append(f'{speaker}|{text}')
+
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((history, future, time.perf_counter()))
+        response = await future
+
+        # the agent's own replies are part of the conversation that later turns see
+        if response['Nextstep'] == 'retrieve_utterance':
+          history.append(f"agent|{response['Utterance']}")
+        elif response['Nextstep'] == 'take_action':
+          history.append(f"action|{response['Action']}")
+          history.action_taken = True
+        return response
+    finally:
+      self.sessions.release(session_id, history)
+
+  async def next_batch(self):
+    batch = [await self.queue.get()]
+    deadline = batch[0][2] + self.max_delay
+    while len(batch) < self.max_batch_size:
+      if not self.queue.empty():   # turns which are already waiting join even past the deadline
+        batch.append(self.queue.get_nowait())
+        continue
+      remaining = deadline - time.perf_counter()
+      if remaining <= 0:
+        break
+      try:
+        batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+      except asyncio.TimeoutError:
+        break
+    return batch
+
+  async def run(self):
+    loop = asyncio.get_running_loop()
+    while True:
+      batch = await self.next_batch()
+      histories = [history for history, _, _ in batch]
+      try:
+        responses = await loop.run_in_executor(None, self.app.respond, histories)
+      except Exception as error:
+        for _, future, _ in batch:
+          future.set_exception(error)
+        continue
+
+      finished = time.perf_counter()
+      self.stats.record_batch([finished - arrival for _, _, arrival in batch])
+      for (_, future, _), response in zip(batch, responses):
+        if not future.done():
+          future.set_result(response)
+
+class ChatServer(object):
+  """ A small HTTP front end to the MicroBatcher, served over TCP or a Unix socket.  Routes:
+    POST /turn  {"session_id", "text", "speaker"}  returns the next step of the conversation
+    POST /end   {"session_id"}                     forgets about a finished conversation
+    GET  /stats                                    returns latency percentiles and batch sizes
+  """
+  reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}
+
+  def __init__(self, batcher):
+    self.batcher = batcher
+
+  async def serve(self, host='127.0.0.1', port=8000, socket_path=None, snapshot_path=None,
+                    snapshot_interval=60):
+    sessions = self.batcher.sessions
+    if snapshot_path is not None and os.path.exists(snapshot_path):
+      print(f"Restored {sessions.restore(snapshot_path)} sessions from {snapshot_path}")
+    self.batcher.start()
+    if socket_path is not None:
+      server = await asyncio.start_unix_server(self.handle, path=socket_path)
+      print(f"Serving on {socket_path}")
+    else:
+      server = await asyncio.start_server(self.handle, host, port)
+      print(f"Serving on http://{host}:{port}")
+
+    try:
+      async with server:
+        while True:
+          await asyncio.sleep(snapshot_interval)
+          sessions.evict()    # idle sessions expire even when no new turns arrive
+          if snapshot_path is not None:
+            sessions.snapshot(snapshot_path)
+    finally:
+      if snapshot_path is not None:
+        sessions.snapshot(snapshot_path)
+
+  async def handle(self, reader, writer):
+    try:
+      while True:   # connections are kept alive until the client closes them
+        request_line = await reader.readline()
+        if not request_line:
+          break
+        method, path, _ = request_line.decode('latin-1').split(' ', 2)
+        headers = {}
+        while True:
+          line = (await reader.readline()).decode('latin-1').strip()
+          if not line:
+            break
+          name, value = line.split(':', 1)
+          headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+        status, payload = await self.route(method, path, body)
+        content = json.dumps(payload).encode('utf-8')
+        writer.write(f"HTTP/1.1 {status} {self.reasons[status]}\r\nContent-Type: application/json\r\n"
+                     f"Content-Length: {len(content)}\r\n\r\n".encode('latin-1') + content)
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+      pass
+    finally:
+      writer.close()
+
+  async def route(self, method, path, body):
+    if method == 'GET' and path == '/stats':
+      sessions = self.batcher.sessions
+      return 200, dict(self.batcher.stats.summary(), sessions=len(sessions), evicted=sessions.num_evicted)
+    if method != 'POST' or path not in ['/turn', '/end']:
+      return 404, {'error': f'no route for {method} {path}'}
+
+    try:
+      request = json.loads(body or b'{}')
+    except ValueError:
+      request = None
+    if not isinstance(request, dict) or 'session_id' not in request:
+      return 400, {'error': 'expected a json object with a session_id'}
+    session_id = str(request['session_id'])
+
+    if path == '/end':
+      self.batcher.end_session(session_id)
+      return 200, {'session_id': session_id}
+    if 'text' not in request:
+      return 400, {'error': 'expected the text of the turn'}
+    try:
+      response = await self.batcher.submit(session_id, request['text'], request.get('speaker', 'customer'))
+    except Exception as error:
+      return 500, {'error': str(error)}
+    return 200, dict(response, session_id=session_id)
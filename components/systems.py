@@ -1,40 +1,45 @@
 import os, sys, pdb
+import re
+import csv
 import random
+import pickle
+import hashlib
 import numpy as np
 import json
-import pandas as pd
+import torch
+
+from utils.process import DialogueHistory
 
 class Application(object):
   def __init__(self, args, model, processor):
     self.task = args.task
-    self.utt_vectors = model.utt_vectors
-    self.utt_texts = model.utt_texts
-    self.device = model.device
-
-    tokenizer = processor.tokenizer
-    cls_token_segment_id = 0
-    sequence_a_segment_id = 0 if args.model_type in ['roberta', 'large'] else 1
-    processor.special = { 'tokens': [tokenizer.cls_token, tokenizer.sep_token, tokenizer.pad_token],
-      'ids': [cls_token_segment_id, sequence_a_segment_id, 0], 'maximum': [97, 100] }
+    self.model = model
+    self.utt_vectors = getattr(model, 'utt_vectors', None)
+    self.utt_texts = getattr(model, 'utt_texts', [])
+    self.device = next(model.parameters()).device
 
     self.processor = processor
-    self.tokenizer = tokenizer
+    self.tokenizer = processor.tokenizer
+    self.pad_id = self.tokenizer.convert_tokens_to_ids(self.tokenizer.pad_token)
 
-    self.intent_list = processor.intent_labels
-    self.action_list = processor.action_labels
-    self.value_list = processor.value_labels
+    self.intent_list = list(processor.mappers['intent'].keys())
+    self.nextstep_list = list(processor.mappers['nextstep'].keys())
+    self.action_list = list(processor.mappers['action'].keys())
+    self.value_list = list(processor.mappers['value'].keys())
     self.enumerable_size = len(self.value_list)
 
-    self.scenario_df = pd.read_csv(f'data/scenarios_0525.csv')
-    ontology = json.load( open("data/ontology.json", "r") )
+    self.scenario_path = os.path.join(args.input_dir, 'scenarios_0525.csv')
+    self.scenario_cache = os.path.join(args.input_dir, 'cache')
+    self.seed = args.seed
+    self.scenarios = None   # only loaded once a scenario is sampled
+    ontology = processor.ontology
     self.non_enumerable = ontology["values"]["non_enumerable"]
-    self.so_far = []  # hold a list of context utterances
-    self.action_taken = False
+    # per conversation state, such as the history, scene and whether an action was taken,
+    # lives with each session in components/serving.SessionStore rather than on the app
 
-    kb = json.load( open("data/kb.json", "r"))
-    action_mask_map, intent_mask_map = Application.prepare_masks(kb, ontology)
-    self.action_mask_map = action_mask_map
-    self.intent_mask_map = intent_mask_map
+    kb = json.load( open(os.path.join(args.input_dir, "kb.json"), "r"))
+    self.constraints = KBConstraints.load(self.intent_list, self.action_list, (kb, ontology),
+                                            os.path.join(args.input_dir, 'cache'))
 
   @staticmethod
   def prepare_masks(kb, ont):
@@ -108,49 +113,207 @@ class Application(object):
     """ Given all the utterances within a converation and the scenario, delexicalize the 
     non enumerable entities. Inputs:
       - scene: a dict with detail, personal_info and order info
-      - conversation: a list of utterances tuples where each tuple is (speaker, text, action, pred)
+      - conversation: a list of utterance strings
     Returns:
       - delex: a list of utterances where the text has been delexicalized
     """
-    non_enumerable = []
+    delexicalizer = Delexicalizer.from_scene(scene, self.non_enumerable)
+    return delexicalizer.conversation(conversation)
+
+  def sample_scenario(self, session=None, flow=None, subflow=None, balanced=False):
+    """ Draws a scenario for a simulated customer, optionally restricted to a flow or subflow.
+    With balanced, every subflow is equally likely rather than weighted by its frequency. """
+    if self.scenarios is None:
+      self.scenarios = ScenarioStore.load(self.scenario_path, self.scenario_cache, self.seed)
+    scene, prompt = self.scenarios.sample(flow, subflow, balanced)
+    if session is not None:
+      session.scene = scene
+    return scene, prompt
+
+  def pad_rows(self, rows):
+    # rows of (token_ids, segment_ids, mask_ids) padded to the longest into model inputs
+    width = max(len(token_ids) for token_ids, _, _ in rows)
+    input_ids = torch.full((len(rows), width), self.pad_id, dtype=torch.long)
+    segment_ids = torch.zeros((len(rows), width), dtype=torch.long)
+    mask_ids = torch.zeros((len(rows), width), dtype=torch.long)
+    for row, (token_ids, segments, mask) in enumerate(rows):
+      input_ids[row, :len(token_ids)] = torch.tensor(token_ids)
+      segment_ids[row, :len(segments)] = torch.tensor(segments)
+      mask_ids[row, :len(mask)] = torch.tensor(mask)
+    return {'input_ids': input_ids.to(self.device), 'token_type_ids': segment_ids.to(self.device),
+            'attention_mask': mask_ids.to(self.device)}
+
+  def collate(self, histories):
+    """ Turns a list of DialogueHistory into the batched history and context inputs of the
+    model, along with the context tokens that each row is able to copy values from """
+    windows = [history.candidate_window(97)[0] for history in histories]  # leaves room for [CLS] and [SEP]
+    contexts = [self.processor.convert_context_tokens(window, pad=False) for window in windows]
+    full_history = self.pad_rows([history.embed() for history in histories])
+    context_tokens = self.pad_rows([(c['token_ids'], c['segment_ids'], c['mask_ids']) for c in contexts])
+    return full_history, context_tokens, windows
+
+  def respond(self, histories):
+    """ Predicts the next step of many conversations at once with a single batched pass.  Inputs:
+      - histories: a list of DialogueHistory, one for each conversation
+    Returns:
+      - a list of dicts holding the Nextstep, along with the Utterance to say when retrieving
+        or the Intent, Action and Value when taking an action
+    """
+    full_history, context_tokens, windows = self.collate(histories)
+    scores = self.model.predict(full_history, context_tokens, k=1)
+    intent_pred, nextstep_pred, action_pred, value_pred = [s.cpu().numpy() for s in scores[:4]]
+    utt_ids = scores[4][1][:, 0].tolist()
+
+    responses = []
+    for row, window in enumerate(windows):
+      nextstep = self.nextstep_list[np.argmax(nextstep_pred[row])]
+      response = {'Nextstep': nextstep}
+      if nextstep == 'retrieve_utterance':
+        response['Utterance'] = self.utt_texts[utt_ids[row]]
+      elif nextstep == 'take_action':
+        response.update(self.take_action(intent_pred[row], action_pred[row], value_pred[row], window))
+      responses.append(response)
+    return responses
+
+  def retrieve_utterances(self, conversation, k=10):
+    """ Searches the entire utterance bank, rather than a sampled set of candidates, for the
+    best agent responses to the conversation so far.  Inputs:
+      - conversation: a list of utterances, each a 'speaker|text' string
+      - k: the number of utterances to return
+    Returns:
+      - a list of (utterance, score) tuples sorted from best to worst
+    """
+    history = DialogueHistory(self.processor)
+    for utterance in conversation:
+      history.append(utterance)
+    full_history = self.pad_rows([history.embed()])
+    scores, utt_ids = self.model.retrieve(full_history, k)
+
+    ranked = zip(utt_ids[0].tolist(), scores[0].tolist())
+    return [(self.utt_texts[utt_id], score) for utt_id, score in ranked if utt_id >= 0]
+
+  def take_action(self, intent_pred, action_pred, value_pred, context_tokens):
+    top_intent = np.argmax(intent_pred)
+    intent_name = self.intent_list[top_intent]
 
-    for slot in self.non_enumerable['personal']:
-      if slot in scene:
-        non_enumerable.append((slot, scene[slot]))
+    # all actions which are not valid for the intent go to zero
+    action_pred = self.constraints.mask_actions(top_intent, action_pred)
+    top_action = np.argmax(action_pred)
+    action_name = self.action_list[top_action]
+
+    # all values which are not valid for the action go to zero
+    value_pred = self.constraints.mask_values(top_action, value_pred)
+    top_value = np.argmax(value_pred)
+    if top_value < self.enumerable_size:  # part of enumerable
+      value_name = self.value_list[top_value]
+    else:                                 # copy from context
+      top_value -= self.enumerable_size
+      # positions past the tokens seen so far are padding, which leaves nothing to copy
+      value_name = context_tokens[top_value] if top_value < len(context_tokens) else None
 
+    return {'Intent': intent_name, 'Action': action_name, 'Value': value_name}
+
+class Delexicalizer(object):
+  """ Replaces the non enumerable values of one scenario with their slot tokens.  All the values
+  are compiled into a single regex alternation ordered longest first, so each utterance is
+  rewritten in one pass and a value containing another, such as a full address containing its
+  street address, always wins.  Values only match as whole words, so an amount of $5 is not
+  replaced within an order id, and any run of whitespace within a value matches any other. """
+
+  def __init__(self, entities):
+    self.slots = {}   # normalized value to its slot, the first slot listed for a value wins
+    for slot, value in entities:
+      value = self.normalize(str(value))
+      if value and value not in self.slots:
+        self.slots[value] = slot
+
+    alternatives = [r'\s+'.join(re.escape(token) for token in value.split())
+                      for value in sorted(self.slots, key=len, reverse=True)]
+    self.pattern = re.compile(r'(?<!\w)(?:' + '|'.join(alternatives) + r')(?!\w)') if alternatives else None
+
+  @staticmethod
+  def normalize(text):
+    return ' '.join(text.replace('|', 'and').replace('_', ' ').lower().split())
+
+  @classmethod
+  def from_scene(cls, scene, non_enumerable):
+    # a scene as built by Application.sample_scenario, where products map to their '$' amount
+    entities = [(slot, scene[slot]) for slot in non_enumerable['personal'] if slot in scene]
     for slot, value in scene.items():
       string_val = str(value)
       if string_val.startswith('$'):
-        non_enumerable.append(('amount', string_val[1:]))
-      if slot == 'order_id':
-        non_enumerable.append((slot, scene[slot]))
+        entities.append(('amount', string_val[1:]))
+    if 'order_id' in scene:
+      entities.append(('order_id', scene['order_id']))
 
     address = scene['address']
-    address_tokens = address.split()
-    address_halves = address.split(',')
-    non_enumerable.append(('street_address', address_halves[0]))
-    non_enumerable.append(('full_address', address[0]))
-    non_enumerable.append(('zip_code', address_tokens[0]))
-
-    delexed = []
-    for utt in conversation:
-      text = utt.replace('|', 'and').replace('_', ' ').lower()
-      # must be in this order to prevent clash
-      for slot, value in non_enumerable:
-        if str(value) in text:
-          text = text.replace(str(value), f'<{slot}>')
-
-      delexed.append(text)
-    return delexed
-
-  def sample_scenario(self):
-    scenario = self.scenario_df.sample()
-    flow_detail = json.loads(scenario['Detail'].item())
-    scene = json.loads(scenario['Personal'].item())  # default scene to the personal info
-
-    order = json.loads(scenario['Order'].item())
+    entities.append(('full_address', address))
+    entities.append(('street_address', scene.get('street_address', address.split(',')[0])))
+    entities.append(('zip_code', address.split()[-1]))
+    return cls(entities)
+
+  @classmethod
+  def from_scenario(cls, scenario, non_enumerable):
+    # the scenario stored with each conversation of the raw data
+    entities = []
+    for category in ['personal', 'order']:
+      details = scenario.get(category, {})
+      entities.extend((slot, details[slot]) for slot in non_enumerable[category] if slot in details)
+    for amount in scenario.get('product', {}).get('amounts', []):
+      entities.append(('amount', amount))
+    return cls(entities)
+
+  def __call__(self, text):
+    text = text.replace('|', 'and').replace('_', ' ').lower()
+    if self.pattern is None:
+      return text
+    return self.pattern.sub(lambda match: f'<{self.slots[self.normalize(match.group())]}>', text)
+
+  def conversation(self, utterances):
+    return [self(utterance) for utterance in utterances]
+
+  @classmethod
+  def corpus(cls, conversations, non_enumerable):
+    """ Delexicalizes a stream of raw conversations, such as those from utils.load.stream_splits
+    with keep_fields=('convo_id', 'scenario', 'original'), compiling one matcher for each.
+    Yields (convo_id, delexed) pairs, where delexed holds (speaker, text) tuples. """
+    for convo in conversations:
+      delexicalizer = cls.from_scenario(convo['scenario'], non_enumerable)
+      yield convo['convo_id'], [(speaker, delexicalizer(text)) for speaker, text in convo['original']]
+
+class ScenarioStore(object):
+  """ Every scenario parsed once into its scene and prompt, with the row ids of each flow and
+  subflow grouped together, so sampling is a constant time lookup rather than a pass over a
+  DataFrame followed by three json decodes.  The parsed store is cached on disk next to the
+  other compiled inputs and is rebuilt whenever the csv changes. """
+
+  columns = ['Detail', 'Personal', 'Order', 'Flow', 'Subflow']
+
+  def __init__(self, scenes, prompts, flows, subflows, seed=None):
+    self.scenes = scenes
+    self.prompts = prompts
+    self.flows = flows
+    self.subflows = subflows
+    self.groups = {}    # (flow, subflow) to the row ids which match, where None matches anything
+    for row, (flow, subflow) in enumerate(zip(flows, subflows)):
+      for key in [(flow, None), (None, subflow), (flow, subflow)]:
+        self.groups.setdefault(key, []).append(row)
+    self.groups = {key: np.array(rows, dtype=np.int32) for key, rows in self.groups.items()}
+    self.pairs = sorted(key for key in self.groups if None not in key)
+    self.rng = random.Random(seed)   # seeded from --seed so the same customers are drawn each run
+
+  def __len__(self):
+    return len(self.scenes)
+
+  @staticmethod
+  def parse(scenario):
+    flow_detail = json.loads(scenario['Detail'])
+    scene = json.loads(scenario['Personal'])  # default scene to the personal info
+
+    order = json.loads(scenario['Order'])
     street_address = order['address']
     scene['address'] = f"{street_address} {order['city']}, {order['state']} {order['zip_code']}"
+    scene['street_address'] = street_address
 
     for key, value in order.items():
       if key == 'products':
@@ -159,7 +322,6 @@ class Application(object):
           scene[product_name] = '$' + str(product['amount'])
       if key not in ['address', 'city', 'status', 'zip_code', 'products']:
         scene[key] = value
-    self.scene = scene
 
     issue = flow_detail['issue']
     reason = flow_detail['reason']
@@ -168,30 +330,102 @@ class Application(object):
     suffix = flow_detail.get('suffix', '')
     prompt = f"{prefix}ou {issue} because {reason}. Explain your problem to the agent, provide any information that is requested and attempt to {solution}. {suffix}"""
 
-    return scene, prompt
+    return scene, prompt, scenario['Flow'], scenario['Subflow']
 
-  def take_action(self, intent_pred, action_pred, value_pred, context_tokens):
-    top_intent = np.argmax(intent_pred)
-    intent_name = self.intent_list[top_intent]
+  @classmethod
+  def build(cls, csv_path, seed=None):
+    with open(csv_path, 'r', newline='') as csv_file:
+      reader = csv.DictReader(csv_file)
+      missing = [column for column in cls.columns if column not in (reader.fieldnames or [])]
+      if len(missing) > 0:
+        raise ValueError(f"{csv_path} is missing the scenario columns {missing}")
+      parsed = [cls.parse(scenario) for scenario in reader]
+    if len(parsed) == 0:
+      raise ValueError(f"{csv_path} does not hold any scenarios")
+    return cls(*[list(column) for column in zip(*parsed)], seed=seed)
 
-    # each intent mask should be size of 30 long
-    intent_mask = self.intent_mask_map[intent_name]
-    # now, all non valid actions should go to zero
-    action_pred *= np.array(intent_mask)
-    top_action = np.argmax(action_pred)
-    action_name = self.action_list[top_action]
-    
-    # each action mask should be size of 223 long
-    action_mask = self.action_mask_map[action_name]
-    # now, all non valid values should go to zero
-    value_pred *= np.array(action_mask)
-    top_value = np.argmax(value_pred)
-    if top_value < self.enumerable_size:  # part of enumerable
-      value_name = self.value_list[top_value]
-    else:                                 # copy from context
-      top_value -= self.enumerable_size
-      while top_value > len(context_tokens):
-          top_value -= len(context_tokens)
-      value_name = context_tokens[top_value]
+  @classmethod
+  def load(cls, csv_path, cache_dir='data/cache', seed=None):
+    digest = hashlib.sha1(open(csv_path, 'rb').read()).hexdigest()
+    cache_path = os.path.join(cache_dir, 'scenarios.pkl')
 
-    return {'Intent': intent_name, 'Action': action_name, 'Value': value_name}
+    if os.path.exists(cache_path):
+      cached = pickle.load(open(cache_path, 'rb'))
+      if cached['digest'] == digest:
+        return cls(*cached['columns'], seed=seed)
+
+    store = cls.build(csv_path, seed)
+    os.makedirs(cache_dir, exist_ok=True)
+    columns = (store.scenes, store.prompts, store.flows, store.subflows)
+    pickle.dump({'digest': digest, 'columns': columns}, open(cache_path, 'wb'), pickle.HIGHEST_PROTOCOL)
+    return store
+
+  def sample(self, flow=None, subflow=None, balanced=False):
+    if balanced:    # pick a subflow uniformly first, then a scenario within it
+      pairs = [pair for pair in self.pairs if flow in [None, pair[0]] and subflow in [None, pair[1]]]
+      if len(pairs) == 0:
+        raise KeyError(f"No scenarios for flow {flow} and subflow {subflow}")
+      rows = self.groups[pairs[self.rng.randrange(len(pairs))]]
+    elif flow is None and subflow is None:
+      rows = None
+    else:
+      if (flow, subflow) not in self.groups:
+        raise KeyError(f"No scenarios for flow {flow} and subflow {subflow}")
+      rows = self.groups[(flow, subflow)]
+
+    row = self.rng.randrange(len(self)) if rows is None else rows[self.rng.randrange(len(rows))]
+    # callers are free to modify the scene, so they get a copy of the stored one
+    return dict(self.scenes[row]), self.prompts[row]
+
+class KBConstraints(object):
+  """ The KB guidelines compiled into two dense 0/1 matrices, one row per intent holding the
+  actions it allows and one row per action holding the values it allows, in the same order
+  as the model outputs.  Masking a batch of scores is then a single gather of rows followed
+  by a multiply, which works on both numpy arrays and torch tensors. """
+
+  def __init__(self, intent_action, action_value):
+    self.intent_action = intent_action    # num_intents x num_actions
+    self.action_value = action_value      # num_actions x (num_enumerable_values + 100)
+    self.tensors = {}                     # copies of the matrices for each device and dtype
+
+  @classmethod
+  def compile(cls, intent_list, action_list, guidelines):
+    action_mask_map, intent_mask_map = Application.prepare_masks(*guidelines)
+    intent_action = np.stack([intent_mask_map[intent] for intent in intent_list]).astype(np.float32)
+    action_value = np.stack([action_mask_map[action] for action in action_list]).astype(np.float32)
+    return cls(intent_action, action_value)
+
+  @classmethod
+  def load(cls, intent_list, action_list, guidelines, cache_dir='data/cache'):
+    """ Reads the compiled matrices from cache, compiling and saving them first if the cache is
+    missing or was built from a different kb, ontology or label order. """
+    kb, ontology = guidelines
+    source = json.dumps([kb, ontology, list(intent_list), list(action_list)], sort_keys=True)
+    digest = hashlib.sha1(source.encode('utf-8')).hexdigest()
+    cache_path = os.path.join(cache_dir, 'kb_constraints.npz')
+
+    if os.path.exists(cache_path):
+      cached = np.load(cache_path)
+      if str(cached['digest']) == digest:
+        return cls(cached['intent_action'], cached['action_value'])
+
+    constraints = cls.compile(intent_list, action_list, guidelines)
+    os.makedirs(cache_dir, exist_ok=True)
+    np.savez(cache_path, intent_action=constraints.intent_action,
+              action_value=constraints.action_value, digest=digest)
+    return constraints
+
+  def rows(self, matrix, ids, scores):
+    if not torch.is_tensor(scores):
+      return matrix[ids]
+    key = (id(matrix), scores.device, scores.dtype)
+    if key not in self.tensors:
+      self.tensors[key] = torch.as_tensor(matrix, dtype=scores.dtype, device=scores.device)
+    return self.tensors[key][ids]
+
+  def mask_actions(self, intent_ids, action_scores):
+    # zeroes out the actions not allowed by each intent, ids can be a single index or a batch
+    return action_scores * self.rows(self.intent_action, intent_ids, action_scores)
+
+  def mask_values(self, action_ids, value_scores):
+    return value_scores * self.rows(self.action_value, action_ids, value_scores)
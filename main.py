@@ -6,31 +6,61 @@ from tqdm import tqdm as progress_bar
 
 from utils.arguments import solicit_params
 from utils.help import set_seed, setup_gpus, check_directories, prepare_inputs, device
-from utils.load import load_data, load_tokenizer, load_candidates, get_optimizer, get_scheduler
-from utils.process import process_data, setup_dataloader
-from utils.evaluate import quantify, qualify
+from utils.load import load_data, load_tokenizer, load_candidates, load_guidelines
+from utils.load import get_optimizer, get_scheduler
+from utils.process import process_data, setup_dataloader, prepare_intent_labels, prepare_action_labels
+from utils.evaluate import quantify, qualify, MetricAccumulator, PredictionWriter, load_predictions
 
 from components.datasets import ActionDataset, CascadeDataset
 from components.tools import ExperienceLogger
 from components.models import ActionStateTracking, CascadeDialogSuccess
+from components.systems import KBConstraints
 
 def run_main(args, datasets, model, exp_logger):
   if args.task == 'cds':
     utt_data = load_candidates(args)
     model.add_candidate_data(*utt_data)
-  kb_labels = {}
-  if args.use_kb:
-    kb_labels['intent'] = list(model.mappings['intent'].keys())
-    kb_labels['action'] = list(model.mappings['action'].keys())
-
-  exp_logger.init_tb_writers()
-  run_train(args, datasets, model, exp_logger, kb_labels)
-
-  if args.do_eval:
-    result = run_eval(args, datasets, model, exp_logger, kb_labels, split='test')
+  kb_labels = build_kb_labels(args, model.mappings)
+
+  if not args.do_eval:
+    exp_logger.init_tb_writers()
+    run_train(args, datasets, model, exp_logger, kb_labels)
+  else:   # the model was restored from its checkpoint, so go straight to evaluation
+    save_dir = os.path.dirname(exp_logger.filepath)
+    save_path = os.path.join(save_dir, 'predictions_test') if args.save_predictions else None
+    result = run_eval(args, datasets, model, exp_logger, kb_labels, split='test', save_path=save_path)
     results = dict((k + f'_{args.filename}', v) for k, v in result.items())
     print('Test Results -', results)
 
+def build_kb_labels(args, mappings, guidelines=None):
+  kb_labels = {}
+  if args.use_kb:
+    kb_labels['intent'] = list(mappings['intent'].keys())
+    kb_labels['action'] = list(mappings['action'].keys())
+    guidelines = load_guidelines() if guidelines is None else guidelines
+    kb_labels['constraints'] = KBConstraints.load(kb_labels['intent'], kb_labels['action'],
+                                                    guidelines, os.path.join(args.input_dir, 'cache'))
+  return kb_labels
+
+def run_rescore(args, ckpt_dir):
+  """ Recomputes the reports from the predictions saved by an earlier --save-predictions run,
+  so that --use-kb and --cascade can be toggled without running the model again """
+  save_path = os.path.join(ckpt_dir, 'predictions_test')
+  records, manifest = load_predictions(save_path, os.path.join(ckpt_dir, 'pytorch_model.pt'))
+  if manifest['task'] != args.task:
+    raise ValueError(f"Predictions in {save_path} were saved for {manifest['task']}, not {args.task}")
+
+  kb_guidelines, ontology = load_guidelines()
+  mappings = {'intent': prepare_intent_labels(ontology), 'action': prepare_action_labels(ontology)}
+  accumulator = MetricAccumulator(args, build_kb_labels(args, mappings, (kb_guidelines, ontology)))
+  for start in range(0, len(records), args.batch_size * 100):
+    accumulator.tally(records[start:start + args.batch_size * 100])
+
+  metrics, res_name = accumulator.report()
+  results = dict((k + f'_{args.filename}', v) for k, v in metrics.items())
+  print('Rescored Results -', results)
+  return metrics
+
 def ast_loss(scores, targets, loss_func):
   action_score, value_score = scores
   action_target, value_target = targets
@@ -69,20 +99,20 @@ def cds_loss(scores, targets, loss_func):
   return total_loss
 
 def run_train(args, datasets, model, exp_logger, kb_labels):
-  dataloader, num_examples = setup_dataloader(datasets, args.batch_size, split='train')
+  dataloader, num_examples = setup_dataloader(args, datasets, split='train')
   t_total = len(dataloader) // args.grad_accum_steps * args.epochs    
   exp_logger.start_train(num_examples, total_step=t_total)
   optimizer = get_optimizer(args, model)
   scheduler = get_scheduler(args, optimizer, t_total)
   loss_func = torch.nn.CrossEntropyLoss(ignore_index=-1)
+  # fp16 gradients can underflow, so the loss is scaled up before the backward pass
+  scaler = torch.amp.GradScaler('cuda', enabled=args.precision == 'fp16')
   model.zero_grad()
 
   for epoch in range(args.epochs):
     model.train()
 
     for step, batch in enumerate(dataloader):
-      batch = tuple(t.to(device) for t in batch)
-
       if args.task == 'ast':
         full_history, targets, context_tokens, _ = prepare_inputs(args, batch)
         scores = model(full_history, context_tokens)
@@ -94,12 +124,19 @@ def run_train(args, datasets, model, exp_logger, kb_labels):
 
       if args.grad_accum_steps > 1:
         loss = loss / args.grad_accum_steps
-      loss.backward()
-      torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+      scaler.scale(loss).backward()
+      if not scaler.is_enabled():
+        torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
 
       if (step+1) % args.grad_accum_steps == 0:
-        optimizer.step()
-        scheduler.step()
+        if scaler.is_enabled():   # gradients must be unscaled before they can be clipped
+          scaler.unscale_(optimizer)
+          torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+        scale = scaler.get_scale()
+        scaler.step(optimizer)
+        scaler.update()
+        if scaler.get_scale() >= scale:   # the scale only drops when inf or nan gradients skipped the step
+          scheduler.step()
         model.zero_grad()
         result, metric = quantify(args, scores, targets, "train")
         exp_logger.log_train(step, loss.item(), result, metric)
@@ -114,16 +151,17 @@ def run_train(args, datasets, model, exp_logger, kb_labels):
         exp_logger.best_score = dev_score
     exp_logger.log_dev(step+1, res_name, dev_score)
 
-def run_eval(args, datasets, model, exp_logger, kb_labels, split='dev'):
-  dataloader, num_examples = setup_dataloader(datasets, args.batch_size, split)  
+def run_eval(args, datasets, model, exp_logger, kb_labels, split='dev', save_path=None):
+  dataloader, num_examples = setup_dataloader(args, datasets, split)
   exp_logger.start_eval(num_examples, kind=args.filename)
   loss_func = torch.nn.CrossEntropyLoss(ignore_index=-1)
-  num_outputs = len(model.outputs)
+  # each batch is reduced to counts of correct predictions as it arrives, rather than held onto
+  accumulator = MetricAccumulator(args, kb_labels)
+  if save_path is not None:
+    writer = PredictionWriter(save_path, num_examples, exp_logger.filepath)
   model.eval()
 
-  preds, labels, convo_ids, turn_counts = [], [], [], []
   for batch in progress_bar(dataloader, total=len(dataloader), desc=f"Epoch {exp_logger.epoch}"):
-    batch = tuple(t.to(device) for t in batch)
     full_history, batch_targets, context_tokens, tools = prepare_inputs(args, batch)
 
     with torch.no_grad():
@@ -134,30 +172,25 @@ def run_eval(args, datasets, model, exp_logger, kb_labels, split='dev'):
         batch_scores = model(full_history, context_tokens, tools)
         batch_loss = cds_loss(batch_scores, batch_targets, loss_func)
 
-    if args.cascade:
-      batch_turn_count = batch_targets.pop()
-      batch_convo_id = batch_targets.pop()
+    batch_convo_id, batch_turn_count = None, None
+    if args.task == 'cds':  # also kept in the saved predictions, so they can be rescored with cascading
+      batch_convo_id, batch_turn_count = batch[12], batch[13]
+    records = accumulator.add(batch_scores, batch_targets, batch_convo_id, batch_turn_count)
+    if save_path is not None:
+      writer.write(records)
 
     if args.quantify or split=='dev':
       exp_logger.eval_loss += batch_loss.mean().item()
       exp_logger.batch_steps += 1
-    
-    preds.append(batch_scores)
-    labels.append(batch_targets)
-    convo_ids.append(batch_convo_id if args.cascade else 0)
-    turn_counts.append(batch_turn_count if args.cascade else 0)
 
     if args.debug:
-      if len(turn_counts) > 10:
+      if accumulator.num_batches > 10:
         break
-    
-  grouped_preds = [torch.cat([pred[i] for pred in preds], dim=0) for i in range(num_outputs)]
-  grouped_labels = [torch.cat([label[i] for label in labels], dim=0) for i in range(num_outputs)]
-  ci_and_tc = (torch.cat(convo_ids, dim=0), torch.cat(turn_counts, dim=0)) if args.cascade else (0, 0)
 
-  utils = { 'kb_labels': kb_labels, 'ci_and_tc': ci_and_tc }
-  metrics, res_name = quantify(args, grouped_preds, grouped_labels, utils)
+  metrics, res_name = accumulator.report()
   exp_logger.end_eval(metrics, kind=args.filename)
+  if save_path is not None:
+    writer.close(args)
   return (metrics, res_name) if split == 'dev' else metrics
 
 if __name__ == "__main__":
@@ -166,6 +199,10 @@ if __name__ == "__main__":
   set_seed(args)
 
   ckpt_dir, cache_results = check_directories(args)
+  if args.rescore:
+    run_rescore(args, ckpt_dir)
+    sys.exit()
+
   raw_data = load_data(args, cache_results[1])
   tokenizer, ontology = load_tokenizer(args)
   features, mappings = process_data(args, tokenizer, ontology, raw_data, *cache_results)
@@ -173,11 +210,15 @@ if __name__ == "__main__":
 
   if args.task == 'ast':
     datasets = {split: ActionDataset(args, feats) for split, feats in features.items()}
-    model = ActionStateTracking(args, mappings, ckpt_dir)
+    model_class = ActionStateTracking
   elif args.task == 'cds':
     datasets = {split: CascadeDataset(args, feats) for split, feats in features.items()}
-    model = CascadeDialogSuccess(args, mappings, ckpt_dir)
+    model_class = CascadeDialogSuccess
 
+  if args.do_eval:
+    model = model_class.from_pretrained(args, mappings, ckpt_dir, len(tokenizer))
+  else:
+    model = model_class(args, mappings, ckpt_dir)
+    model.encoder.resize_token_embeddings(len(tokenizer))
   model = model.to(device)
-  model.encoder.resize_token_embeddings(len(tokenizer))
   run_main(args, datasets, model, exp_logger)
@@ -0,0 +1,73 @@
+import os, sys, pdb
+import re
+import json
+import pytest
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+data_dir = os.path.join(repo_dir, 'data')
+
+torch = pytest.importorskip('torch')
+transformers = pytest.importorskip('transformers')
+
+@pytest.fixture
+def sample_convos():
+  return json.load(open(os.path.join(data_dir, 'abcd_sample.json'), 'r'))
+
+@pytest.fixture
+def make_args(tmp_path, monkeypatch):
+  """ Builds the default options of main.py with some of them overridden, pointing every output
+  into a temporary folder and shrinking the encoder down to something which runs in seconds """
+  from utils.arguments import solicit_params
+
+  def make(**overrides):
+    monkeypatch.setattr(sys, 'argv', ['main.py'])
+    args = solicit_params()
+    args.input_dir, args.output_dir = data_dir, str(tmp_path)
+    args.hidden_dim, args.n_gpu = 32, 0
+    for name, value in overrides.items():
+      setattr(args, name, value)
+    return args
+  return make
+
+@pytest.fixture
+def tiny_tokenizer(tmp_path, sample_convos):
+  # a word level vocab covering the sample conversations, with the special slot tokens added
+  words = set()
+  for convo in sample_convos:
+    for turn in convo['delexed']:
+      words.update(re.findall(r'[a-z]+', turn['text'].lower()))
+  vocab_path = tmp_path / 'vocab.txt'
+  vocab_path.write_text('\n'.join(['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + sorted(words)))
+
+  tokenizer = transformers.BertTokenizer(str(vocab_path))
+  ontology = json.load(open(os.path.join(data_dir, 'ontology.json'), 'r'))
+  non_enumerable = ontology['values']['non_enumerable']
+  tokenizer.add_tokens([f'<{slot}>' for category, slots in non_enumerable.items() for slot in slots])
+  return tokenizer, ontology
+
+@pytest.fixture
+def tiny_encoder(monkeypatch):
+  # models build their encoder with from_pretrained, which is swapped for a small random BERT
+  import components.models
+  config = transformers.BertConfig(vocab_size=64, hidden_size=32, num_hidden_layers=1,
+                                    num_attention_heads=2, intermediate_size=64)
+  encoder_class = transformers.BertModel
+  monkeypatch.setattr(components.models, 'BertModel',
+                        type('TinyBert', (), {'from_pretrained': staticmethod(lambda name: encoder_class(config))}))
+  return config
+
+@pytest.fixture
+def tiny_roberta(tmp_path, sample_convos):
+  # a byte level BPE trained on the sample conversations, which encodes words differently after a space
+  from tokenizers import ByteLevelBPETokenizer
+  bpe = ByteLevelBPETokenizer()
+  bpe.train_from_iterator([turn['text'] for convo in sample_convos for turn in convo['delexed']],
+                            vocab_size=600, special_tokens=['<s>', '<pad>', '</s>', '<unk>', '<mask>'])
+  bpe.save_model(str(tmp_path))
+
+  tokenizer = transformers.RobertaTokenizer(str(tmp_path / 'vocab.json'), str(tmp_path / 'merges.txt'))
+  ontology = json.load(open(os.path.join(data_dir, 'ontology.json'), 'r'))
+  non_enumerable = ontology['values']['non_enumerable']
+  tokenizer.add_tokens([f'<{slot}>' for category, slots in non_enumerable.items() for slot in slots])
+  return tokenizer, ontology
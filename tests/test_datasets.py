@@ -0,0 +1,36 @@
+import os, sys, pdb
+import pytest
+import numpy as np
+import torch
+
+from utils.process import ASTProcessor, CDSProcessor, save_features, load_features, setup_dataloader
+from components.datasets import ActionDataset, CascadeDataset
+
+@pytest.mark.parametrize('task', ['ast', 'cds'])
+@pytest.mark.parametrize('bucket_batches', [False, True])
+def test_empty_split(make_args, tiny_tokenizer, sample_convos, tmp_path, task, bucket_batches):
+  args = make_args(task=task, bucket_batches=bucket_batches, batch_size=4)
+  processor = (ASTProcessor if task == 'ast' else CDSProcessor)(args, *tiny_tokenizer)
+  features = {'train': [feat for convo in sample_convos for feat in processor.convo_to_features(convo)],
+              'test': []}
+  save_features(features, str(tmp_path), tiny_tokenizer[0], processor.feature_class)
+  columns = load_features(str(tmp_path))
+
+  full, empty = columns['train'], columns['test']
+  assert sorted(empty.columns) == sorted(full.columns)
+  for name, column in empty.columns.items():
+    if name.endswith('_offsets'):
+      assert list(column) == [0]
+    else:
+      assert len(column) == 0 and column.dtype == full.columns[name].dtype
+      assert column.shape[1:] == full.columns[name].shape[1:]
+
+  dataset_class = ActionDataset if task == 'ast' else CascadeDataset
+  datasets = {split: dataset_class(args, split_columns) for split, split_columns in columns.items()}
+  assert len(datasets['test']) == 0
+  dataloader, num_examples = setup_dataloader(args, datasets, 'test')
+  assert num_examples == 0 and list(dataloader) == []
+
+  # the full split serves batches with one row per example in every tensor
+  batch = datasets['train'][[0, 1, 2]]
+  assert all(len(tensor) == 3 for tensor in batch)
@@ -0,0 +1,94 @@
+import os, sys, pdb
+import json
+import time
+import types
+import socket
+import subprocess
+import threading
+import pytest
+import numpy as np
+
+pytest.importorskip('tensorboardX')
+
+from utils.embed import output_paths, merge_shards, save_progress, text_key, break_stale_lock
+from utils.load import load_candidates
+
+def write_bank(tmp_path, num_shards, hidden_dim=8, model_type='bert'):
+  utt_texts = [f'utterance number {idx}' for idx in range(23)]
+  json.dump(utt_texts, open(tmp_path / 'utterances.json', 'w'))
+  rng = np.random.RandomState(14)
+  expected = rng.randn(len(utt_texts), hidden_dim).astype(np.float32)
+
+  shard_args = []
+  for shard_id in range(num_shards):
+    args = types.SimpleNamespace(input_dir=str(tmp_path), output_name='utt_vectors', batch_size=4,
+              num_shards=num_shards, shard_id=shard_id, dtype='fp32', model_type=model_type)
+    rows = list(range(shard_id, len(utt_texts), num_shards))
+    paths = output_paths(args)
+    vectors = np.lib.format.open_memmap(paths['shard'], mode='w+', dtype=np.float32, shape=(len(rows), hidden_dim))
+    vectors[:] = expected[rows]
+    num_batches = (len(rows) + args.batch_size - 1) // args.batch_size
+    save_progress(paths, vectors, {'model_type': model_type, 'rows': rows, 'completed': num_batches})
+    shard_args.append((args, paths))
+  return utt_texts, expected, shard_args
+
+def test_shards_finishing_together_merge_once(tmp_path):
+  utt_texts, expected, shard_args = write_bank(tmp_path, num_shards=4)
+  merged = []
+  def finish(args, paths):
+    merged.append(merge_shards(args, paths, utt_texts, {}, expected.shape[1]))
+  threads = [threading.Thread(target=finish, args=shard) for shard in shard_args]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+  assert sorted(merged) == [False, False, False, True]
+  paths = shard_args[0][1]
+  assert np.array_equal(np.load(paths['matrix']), expected)
+  manifest = json.load(open(paths['manifest'], 'r'))
+  assert manifest['keys'] == [text_key(text) for text in utt_texts] and manifest['hidden_dim'] == 8
+  assert sorted(os.listdir(tmp_path)) == ['utt_vectors.json', 'utt_vectors.npy', 'utterances.json']
+
+def test_merge_waits_for_every_shard(tmp_path):
+  utt_texts, expected, shard_args = write_bank(tmp_path, num_shards=2)
+  args, paths = shard_args[1]
+  os.remove(paths['progress'])    # the second shard has not saved any progress yet
+  assert not merge_shards(*shard_args[0], utt_texts, {}, expected.shape[1])
+  assert not os.path.exists(paths['matrix']) and not os.path.exists(paths['lock'])
+
+def test_stale_locks_are_broken(tmp_path):
+  utt_texts, expected, shard_args = write_bank(tmp_path, num_shards=1)
+  args, paths = shard_args[0]
+  finished = subprocess.Popen([sys.executable, '-c', 'pass'])
+  finished.wait()
+  with open(paths['lock'], 'w') as lock:   # left by a merge that was killed
+    lock.write(f'{socket.gethostname()} {finished.pid}')
+
+  assert merge_shards(args, paths, utt_texts, {}, expected.shape[1])
+  assert np.array_equal(np.load(paths['matrix']), expected) and not os.path.exists(paths['lock'])
+
+def test_live_and_fresh_locks_are_kept(tmp_path):
+  lock_path = str(tmp_path / 'utt_vectors.merge.lock')
+  with open(lock_path, 'w') as lock:
+    lock.write(f'{socket.gethostname()} {os.getpid()}')
+  assert not break_stale_lock(lock_path)
+
+  open(lock_path, 'w').close()    # the holder has yet to write its pid
+  assert not break_stale_lock(lock_path)
+  old = time.time() - 120
+  os.utime(lock_path, (old, old))
+  assert break_stale_lock(lock_path) and not os.path.exists(lock_path)
+
+def test_load_candidates_checks_the_model(tmp_path):
+  utt_texts, expected, shard_args = write_bank(tmp_path, num_shards=1)
+  merge_shards(*shard_args[0], utt_texts, {}, expected.shape[1])
+
+  args = types.SimpleNamespace(input_dir=str(tmp_path), model_type='bert', hidden_dim=8)
+  texts, vectors = load_candidates(args)
+  assert texts == utt_texts and np.allclose(vectors.numpy(), expected)
+  vectors += 1    # a copy rather than the read only mapping
+  with pytest.raises(ValueError, match='embedded with bert'):
+    load_candidates(types.SimpleNamespace(input_dir=str(tmp_path), model_type='roberta', hidden_dim=8))
+  with pytest.raises(ValueError, match='hidden dim of 768'):
+    load_candidates(types.SimpleNamespace(input_dir=str(tmp_path), model_type='bert', hidden_dim=768))
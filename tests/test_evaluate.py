@@ -0,0 +1,49 @@
+import os, sys, pdb
+import pytest
+import numpy as np
+import torch
+
+pytest.importorskip('sklearn')
+
+from utils.evaluate import quantify, MetricAccumulator
+
+def cds_batch(num_turns=12, seed=0):
+  rng = np.random.RandomState(seed)
+  sizes = [5, 3, 7, 9, 20]   # intents, nextsteps, actions, values and candidates
+  scores = [torch.tensor(rng.randn(num_turns, size), dtype=torch.float32) for size in sizes]
+  targets = [torch.tensor(rng.randint(0, size, num_turns)) for size in sizes]
+  return scores, targets
+
+@pytest.mark.parametrize('cascade', [False, True])
+def test_quantify_train_batch(make_args, cascade):
+  args = make_args(task='cds', cascade=cascade, verbose=True)
+  scores, targets = cds_batch()
+  result, metric = quantify(args, scores, targets, 'train')
+
+  assert metric == 'Turn_Accuracy' and 'Cascading_Score' not in result
+  accumulator = MetricAccumulator(args, cascade=False)
+  accumulator.add(scores, targets)
+  assert result == accumulator.report()[0]
+
+def test_quantify_cascade_with_convo_ids(make_args):
+  args = make_args(task='cds', cascade=True)
+  scores, targets = cds_batch()
+  convo_ids, turn_counts = torch.arange(12) // 4, torch.arange(12) % 4
+  result, metric = quantify(args, scores, targets, {'kb_labels': None, 'ci_and_tc': (convo_ids, turn_counts)})
+  assert metric == 'Cascading_Score' and 0 <= result['Cascading_Score'] <= result['Turn_Accuracy']
+
+def test_batch_without_values_scores_nan(make_args):
+  args = make_args(task='cds', cascade=False)
+  scores, targets = cds_batch()
+  targets[3] = torch.full_like(targets[3], -1)   # no turn in the batch called for a value
+  result, metric = quantify(args, scores, targets, {'kb_labels': None})
+  assert np.isnan(result['Value_Accuracy']) and np.isfinite(result['Turn_Accuracy'])
+
+def test_constraints_are_cached_under_the_input_dir(make_args, tmp_path):
+  from utils.process import prepare_intent_labels, prepare_action_labels
+  from utils.load import load_guidelines
+  args = make_args(task='cds', use_kb=True, input_dir=str(tmp_path))
+  kb, ontology = load_guidelines()
+  kb_labels = {'intent': list(prepare_intent_labels(ontology)), 'action': list(prepare_action_labels(ontology))}
+  assert MetricAccumulator(args, kb_labels).constraints is not None
+  assert os.path.exists(tmp_path / 'cache' / 'kb_constraints.npz')
@@ -0,0 +1,37 @@
+import os, sys, pdb
+import io
+import gzip
+import json
+import pytest
+
+pytest.importorskip('tensorboardX')
+
+from utils.load import JSONStreamReader, stream_splits
+
+def test_values_split_across_chunks():
+  values = [{'text': 'café \\"quoted\\" , [not, an, array]', 'turns': [1, 2.5, None, True]},
+              'a string longer than the chunk', -12345, [], {}]
+  reader = JSONStreamReader(io.StringIO(' [ ' + ' ,\n'.join(json.dumps(value) for value in values) + ' ] '), chunk_size=7)
+  reader.expect('[')
+  assert list(reader.iter_array()) == values
+
+def test_stream_gzipped_splits(tmp_path, sample_convos):
+  raw = {'train': sample_convos, 'dev': [], 'test': sample_convos[:1], 'extra': sample_convos[1:]}
+  data_path = str(tmp_path / 'abcd_v1.1.json.gz')
+  with gzip.open(data_path, 'wt', encoding='utf-8') as dump:
+    json.dump(raw, dump, indent=1)
+
+  expected = {split: [{'convo_id': convo['convo_id'], 'delexed': convo['delexed']} for convo in convos]
+                for split, convos in raw.items()}
+  seen = []
+  for split, conversations in stream_splits(data_path, chunk_size=7):
+    seen.append(split)
+    if split in ['train', 'extra']:
+      continue    # skipped splits are drained before moving on
+    assert list(conversations) == expected[split]
+  assert seen == ['train', 'dev', 'test', 'extra']
+
+def test_stream_empty_dump(tmp_path):
+  data_path = str(tmp_path / 'empty.json')
+  open(data_path, 'w').write(' { } ')
+  assert list(stream_splits(data_path, chunk_size=7)) == []
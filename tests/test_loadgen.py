@@ -0,0 +1,28 @@
+import os, sys, pdb
+import types
+import pytest
+
+pytest.importorskip('tensorboardX')
+
+from utils.process import CDSProcessor
+from utils.loadgen import LoadTest, synthesize_turns
+
+def test_synthesized_turns_follow_the_scene(make_args, tiny_tokenizer, sample_convos):
+  processor = CDSProcessor(make_args(task='cds'), *tiny_tokenizer)
+  non_enumerable = processor.ontology['values']['non_enumerable']
+  convo = sample_convos[0]
+  scene = {'customer_name': 'jo ann', 'username': 'jann410', 'email': 'jann410@email.com',
+           'phone': '(555) 010-4477', 'order_id': '5550104477', 'jeans': '$12',
+           'address': '12 elm st springfield, ca 94010', 'street_address': '12 elm st'}
+
+  delexicalizer, texts = synthesize_turns(convo, scene, non_enumerable)
+  expected = [turn['text'] for turn in convo['delexed'] if turn['speaker'] == 'customer']
+  assert any('jann410' in text for text in texts)
+  assert [delexicalizer(text) for text in texts] == expected
+
+def test_sampling_scenarios_needs_the_csv(make_args, tiny_tokenizer, sample_convos, tmp_path):
+  args = make_args(task='cds', sample_scenarios=True)
+  processor = CDSProcessor(args, *tiny_tokenizer)
+  app = types.SimpleNamespace(processor=processor, scenario_path=str(tmp_path / 'scenarios_0525.csv'))
+  with pytest.raises(FileNotFoundError, match='sample-scenarios'):
+    LoadTest(args, app, sample_convos)
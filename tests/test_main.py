@@ -0,0 +1,64 @@
+import os, sys, pdb
+import pytest
+import numpy as np
+import torch
+
+pytest.importorskip('tensorboardX')
+pytest.importorskip('sklearn')
+
+import main
+from utils.process import CDSProcessor
+from components.datasets import FeatureColumns, CascadeDataset
+from components.models import CascadeDialogSuccess
+from components.tools import ExperienceLogger
+
+def build_cds(args, tokenizer, ontology, convos):
+  processor = CDSProcessor(args, tokenizer, ontology)
+  features = [feat for convo in convos for feat in processor.convo_to_features(convo)]
+  pad_id = tokenizer.convert_tokens_to_ids(tokenizer.pad_token)
+  columns = FeatureColumns.from_features(features, len(tokenizer), pad_id, processor.feature_class)
+
+  model = CascadeDialogSuccess(args, processor.mappers, args.output_dir)
+  model.encoder.resize_token_embeddings(len(tokenizer))
+  num_candidates = int(np.asarray(columns.columns['candidates']).max()) + 1
+  model.add_candidate_data([f'utterance {idx}' for idx in range(num_candidates)],
+                             torch.randn(num_candidates, args.hidden_dim))
+  return {'test': CascadeDataset(args, columns)}, model
+
+@pytest.mark.parametrize('use_kb', [False, True])
+def test_run_eval_with_cascade(make_args, tiny_tokenizer, tiny_encoder, sample_convos, use_kb):
+  args = make_args(task='cds', cascade=True, use_kb=use_kb, batch_size=8, quantify=True)
+  datasets, model = build_cds(args, *tiny_tokenizer, sample_convos)
+  exp_logger = ExperienceLogger(args, args.output_dir)
+  kb_labels = main.build_kb_labels(args, model.mappings)
+
+  metrics = main.run_eval(args, datasets, model, exp_logger, kb_labels, split='test')
+  assert 0 <= metrics['Turn_Accuracy'] <= 1 and 0 <= metrics['Cascading_Score'] <= 1
+  assert exp_logger.batch_steps == int(np.ceil(len(datasets['test']) / args.batch_size))
+  assert all(np.isfinite(value) for value in metrics.values() if isinstance(value, float))
+
+def test_run_train_with_cascade(make_args, tiny_tokenizer, tiny_encoder, sample_convos):
+  # verbose training scores every logged batch, which has no convo ids and may hold no values
+  args = make_args(task='cds', cascade=True, verbose=True, batch_size=4, epochs=1, log_interval=1)
+  datasets, model = build_cds(args, *tiny_tokenizer, sample_convos)
+  datasets['train'] = datasets['dev'] = datasets['test']
+  exp_logger = ExperienceLogger(args, args.output_dir)
+  exp_logger.init_tb_writers()
+  main.run_train(args, datasets, model, exp_logger, {})
+  assert exp_logger.global_step == int(np.ceil(len(datasets['train']) / args.batch_size))
+  assert exp_logger.best_score >= 0   # the dev score was recorded
+
+def test_rescore_matches_eval(make_args, tiny_tokenizer, tiny_encoder, sample_convos):
+  args = make_args(task='cds', cascade=False, use_kb=False, batch_size=8)
+  datasets, model = build_cds(args, *tiny_tokenizer, sample_convos)
+  exp_logger = ExperienceLogger(args, args.output_dir)
+  save_path = os.path.join(args.output_dir, 'predictions_test')
+  main.run_eval(args, datasets, model, exp_logger, {}, split='test', save_path=save_path)
+
+  # the saved predictions are rescored under every combination of the ablation flags
+  for cascade in [False, True]:
+    for use_kb in [False, True]:
+      args.cascade, args.use_kb = cascade, use_kb
+      kb_labels = main.build_kb_labels(args, model.mappings)
+      expected = main.run_eval(args, datasets, model, exp_logger, kb_labels, split='test')
+      assert main.run_rescore(args, args.output_dir) == expected
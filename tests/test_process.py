@@ -0,0 +1,31 @@
+import os, sys, pdb
+import pytest
+
+from utils.process import CDSProcessor, DialogueHistory
+
+@pytest.mark.parametrize('model_type', ['bert', 'roberta'])
+def test_history_matches_joined_baseline(make_args, tiny_tokenizer, tiny_roberta, sample_convos, model_type):
+  tokenizer, ontology = tiny_roberta if model_type == 'roberta' else tiny_tokenizer
+  processor = CDSProcessor(make_args(task='cds', model_type=model_type), tokenizer, ontology)
+  sep_token = processor.special['tokens'][1]
+
+  for convo in sample_convos:
+    history, texts = DialogueHistory(processor), []
+    for turn in convo['delexed']:
+      history.append(f"{turn['speaker']}|{turn['text']}")
+      texts.append(turn['text'])
+      # the baseline tokenized the whole history joined by separators at every turn
+      assert history.embed() == processor.embed_utterance(f' {sep_token} '.join(texts), pad=False)
+
+def test_build_features_with_workers(make_args, tiny_tokenizer, sample_convos):
+  import multiprocessing
+  args = make_args(task='cds', build_workers=2, build_chunksize=1)
+  processor = CDSProcessor(args, *tiny_tokenizer)
+  serial = processor.build_features(make_args(task='cds', build_workers=1), [('dev', sample_convos)])
+  pooled = processor.build_features(args, [('dev', sample_convos)])
+  assert [vars(feat) for feat in pooled['dev']] == [vars(feat) for feat in serial['dev']]
+
+  # a convo which fails to process reaches the caller, and the pool is shut down regardless
+  with pytest.raises(KeyError):
+    processor.build_features(args, [('dev', sample_convos + [{'convo_id': -1}])])
+  assert multiprocessing.active_children() == []
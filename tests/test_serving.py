@@ -0,0 +1,93 @@
+import os, sys, pdb
+import time
+import types
+import asyncio
+import pytest
+
+from utils.process import CDSProcessor, DialogueHistory
+from components.serving import SessionHistory, SessionStore, MicroBatcher, ChatServer
+
+@pytest.fixture
+def processor(make_args, tiny_tokenizer):
+  return CDSProcessor(make_args(task='cds'), *tiny_tokenizer)
+
+class SlowApp(object):
+  """ Stands in for the Application, answering every turn after a short delay so that turns
+  are still pending while the test evicts or ends their sessions """
+  def __init__(self, processor, delay=0.05):
+    self.processor = processor
+    self.delay = delay
+
+  def respond(self, histories):
+    time.sleep(self.delay)
+    return [{'Nextstep': 'retrieve_utterance', 'Utterance': 'how can i help'} for _ in histories]
+
+def test_session_history_matches_dialogue_history(processor, sample_convos, tmp_path):
+  # enough unique words to push the first ones out of the copy window, then some of them again
+  words = sorted(tok for tok in processor.tokenizer.get_vocab() if tok.isalpha() and len(tok) > 2)[:130]
+  turns = [f"customer|{' '.join(words[start:start + 10])}" for start in range(0, 130, 10)]
+  turns += [f"agent|{words[0]} {words[5]} {words[129]}", f"customer|{words[64]}"]
+  turns += [f"{turn['speaker']}|{turn['text']}" for turn in sample_convos[0]['delexed']]
+
+  full, compact = DialogueHistory(processor), SessionHistory(processor)
+  for utterance in turns:
+    full.append(utterance)
+    compact.append(utterance)
+    assert compact.embed() == full.embed()
+    assert compact.candidate_window(97) == full.candidate_window(97)
+  assert len(full.candidate_tokens) > 130 and len(compact.candidate_tokens) == compact.window
+
+  sessions = SessionStore(processor)
+  sessions.sessions['a'] = compact
+  sessions.snapshot(str(tmp_path / 'sessions.json'))
+  restored = SessionStore(processor)
+  restored.restore(str(tmp_path / 'sessions.json'))
+  restored.sessions['a'].append('customer|' + words[3])
+  full.append('customer|' + words[3])
+  assert restored.sessions['a'].candidate_window(97) == full.candidate_window(97)
+
+def test_intent_models_are_rejected(make_args, tiny_tokenizer):
+  processor = CDSProcessor(make_args(task='cds', use_intent=True), *tiny_tokenizer)
+  with pytest.raises(ValueError, match='use-intent'):
+    SessionStore(processor)
+
+def test_new_session_survives_when_older_ones_are_busy(processor):
+  sessions = SessionStore(processor, max_sessions=2)
+  older = [sessions.checkout(session_id) for session_id in ['a', 'b']]
+  newest = sessions.get('c')
+  assert list(sessions.sessions) == ['a', 'b', 'c'] and sessions.sessions['c'] is newest
+
+  for session_id, session in zip(['a', 'b'], older):
+    sessions.release(session_id, session)
+  sessions.evict()
+  assert list(sessions.sessions) == ['b', 'c'] and sessions.num_evicted == 1
+
+def test_pending_turns_keep_their_session(processor):
+  sessions = SessionStore(processor, max_sessions=1, ttl=0)
+
+  async def run():
+    batcher = MicroBatcher(SlowApp(processor), sessions, max_batch_size=4, max_delay=0.001)
+    batcher.start()
+    turn = asyncio.get_running_loop().create_task(batcher.submit('a', 'i need a refund'))
+    await asyncio.sleep(0.01)   # the turn is now queued or being answered
+    history = sessions.sessions['a']
+
+    sessions.get('b')           # over capacity and past the ttl, yet the pending session stays
+    sessions.evict()
+    batcher.end_session('a')    # only takes effect once the turn is answered
+    assert sessions.sessions.get('a') is history and history.ended
+
+    response = await turn
+    await batcher.stop()
+    return history, response
+
+  history, response = asyncio.run(run())
+  assert response['Utterance'] == 'how can i help'
+  assert len(history) == 2 and history.pending == 0   # the reply went into the live history
+  assert 'a' not in sessions
+
+@pytest.mark.parametrize('body', [b'[1, 2]', b'"abc"', b'not json', b'{"text": "hi"}'])
+def test_bad_requests_get_a_response(processor, body):
+  server = ChatServer(MicroBatcher(SlowApp(processor), SessionStore(processor)))
+  status, payload = asyncio.run(server.route('POST', '/turn', body))
+  assert status == 400 and 'session_id' in payload['error']
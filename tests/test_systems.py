@@ -0,0 +1,52 @@
+import os, sys, pdb
+import csv
+import json
+import pytest
+
+from components.systems import ScenarioStore
+
+def write_scenarios(path, num_rows=60, columns=ScenarioStore.columns):
+  flows = {'product_defect': ['return_size', 'refund_initiate'], 'storewide_query': ['pricing', 'timing']}
+  rows = []
+  for idx in range(num_rows):
+    flow = sorted(flows)[idx % 2]
+    subflow = flows[flow][(idx // 2) % 2] if idx < num_rows - 1 else flows[flow][0]
+    order = {'address': f'{idx} main st', 'city': 'san mateo', 'state': 'ny', 'zip_code': '75227',
+             'order_id': str(1000 + idx), 'status': 'shipped',
+             'products': [{'brand': 'michael_kors', 'product_type': 'jeans', 'amount': 94}]}
+    row = {'Detail': json.dumps({'issue': 'want a refund', 'reason': 'it broke', 'solution': 'get a refund'}),
+           'Personal': json.dumps({'customer_name': 'crystal minh', 'username': f'user{idx}'}),
+           'Order': json.dumps(order), 'Flow': flow, 'Subflow': subflow}
+    rows.append({column: row[column] for column in columns})
+  with open(path, 'w', newline='') as csv_file:
+    writer = csv.DictWriter(csv_file, fieldnames=columns)
+    writer.writeheader()
+    writer.writerows(rows)
+  return str(path)
+
+def test_sampling_is_seeded(tmp_path):
+  csv_path = write_scenarios(tmp_path / 'scenarios.csv')
+  first = ScenarioStore.load(csv_path, str(tmp_path / 'cache'), seed=14)
+  second = ScenarioStore.load(csv_path, str(tmp_path / 'cache'), seed=14)   # read back from the cache
+  draws = [first.sample()[0]['username'] for _ in range(20)]
+  assert draws == [second.sample()[0]['username'] for _ in range(20)]
+  other = ScenarioStore.load(csv_path, str(tmp_path / 'cache'), seed=15)
+  assert draws != [other.sample()[0]['username'] for _ in range(20)]
+
+def test_sampling_by_flow(tmp_path):
+  store = ScenarioStore.load(write_scenarios(tmp_path / 'scenarios.csv'), str(tmp_path / 'cache'), seed=14)
+  scene, prompt = store.sample(flow='product_defect')
+  assert store.flows[int(scene['order_id']) - 1000] == 'product_defect'
+  assert prompt.startswith('You want a refund because it broke.')
+  assert scene['street_address'] in scene['address']
+
+  for _ in range(20):
+    scene, _ = store.sample(flow='storewide_query', subflow='timing', balanced=True)
+    assert store.subflows[int(scene['order_id']) - 1000] == 'timing'
+  with pytest.raises(KeyError):
+    store.sample(flow='product_defect', subflow='timing')
+
+def test_missing_flow_column(tmp_path):
+  csv_path = write_scenarios(tmp_path / 'scenarios.csv', columns=['Detail', 'Personal', 'Order', 'Flow'])
+  with pytest.raises(ValueError, match='Subflow'):
+    ScenarioStore.load(csv_path, str(tmp_path / 'cache'))
@@ -32,6 +32,10 @@ def solicit_params():
             help='examine the qualitative outputs of the model in natural language')
   parser.add_argument('--quantify', default=False, action='store_true',
             help='examine the quantitative outputs of the model in reports')
+  parser.add_argument('--save-predictions', default=False, action='store_true',
+            help='save the per turn predictions of the test evaluation next to the checkpoint')
+  parser.add_argument('--rescore', default=False, action='store_true',
+            help='recompute the reports from saved predictions rather than running the model again')
 
   # ------- MAJOR MODEL OPTIONS --------
   parser.add_argument('--cascade', default=False, action='store_true',
@@ -40,6 +44,57 @@ def solicit_params():
             help='use an oracle intent classification module')
   parser.add_argument('--use-kb', default=False, action='store_true',
             help='take advantage of KB guidelines to limit action and value options')
+  parser.add_argument('--context-rows', default='all', choices=['all', 'needed', 'predicted'],
+            help='which rows run the context encoder: all of them, only those with context tokens \
+            to copy values from, or at inference only those also predicted to take an action')
+
+  # ------ UTTERANCE RETRIEVAL --------
+  parser.add_argument('--index-type', default='exact', choices=['exact', 'ivfpq'],
+            help='search the full utterance bank exactly, or approximately with an IVF-PQ index')
+  parser.add_argument('--num-lists', default=None, type=int,
+            help='number of coarse clusters in the IVF-PQ index, defaults to the sqrt of the bank size')
+  parser.add_argument('--num-probe', default=8, type=int,
+            help='number of coarse clusters visited by each IVF-PQ search')
+  parser.add_argument('--pq-subspaces', default=16, type=int,
+            help='number of one byte codes that each vector is compressed into')
+
+  # ------ SERVING --------
+  parser.add_argument('--host', default='127.0.0.1', type=str)
+  parser.add_argument('--port', default=8000, type=int)
+  parser.add_argument('--socket-path', default=None, type=str,
+            help='serve over this unix socket rather than over tcp')
+  parser.add_argument('--serve-batch-size', default=32, type=int,
+            help='maximum number of turns answered by one batched pass of the model')
+  parser.add_argument('--batch-deadline', default=10, type=float,
+            help='milliseconds that a turn may wait for others to join its batch')
+  parser.add_argument('--max-sessions', default=10000, type=int,
+            help='number of live sessions kept before the least recently used are evicted')
+  parser.add_argument('--session-ttl', default=1800, type=float,
+            help='seconds that a session may sit idle before it is evicted')
+  parser.add_argument('--session-snapshot', default=None, type=str,
+            help='file that sessions are periodically saved to and restored from on startup')
+  parser.add_argument('--snapshot-interval', default=60, type=float,
+            help='seconds between saving snapshots of the sessions')
+
+  # ------ LOAD TESTING --------
+  parser.add_argument('--conversations', default='data/abcd_sample.json', type=str,
+            help='conversations in the raw format whose customer turns are replayed by utils/loadgen.py')
+  parser.add_argument('--num-conversations', default=200, type=int,
+            help='number of simulated conversations to run before stopping')
+  parser.add_argument('--concurrency', default=16, type=int,
+            help='maximum number of simulated conversations open at once')
+  parser.add_argument('--arrival-rate', default=0, type=float,
+            help='new conversations started per second, or 0 to start one as soon as another ends')
+  parser.add_argument('--sample-scenarios', default=False, action='store_true',
+            help='give each simulated customer a scene from the scenarios csv and synthesize their turns from it')
+  parser.add_argument('--think-time', default=0, type=float,
+            help='seconds a simulated customer waits after each reply before their next turn')
+  parser.add_argument('--report-every', default=5, type=float,
+            help='seconds between progress reports of throughput, latency and memory')
+  parser.add_argument('--report-path', default=None, type=str,
+            help='json file that the final summary and every progress report are written to')
+  parser.add_argument('--untrained', default=False, action='store_true',
+            help='skip loading a checkpoint, which gives the same cost per turn with random outputs')
 
   # ------ DATASET CREATION --------
   parser.add_argument('--version', type=float, default=1.1,
@@ -49,6 +104,10 @@ def solicit_params():
             help='whether to build new vocabulary of Glove vectors')
   parser.add_argument('--max-seq-len', default=512, type=int,
             help='Maximum number of tokens to truncate each utterance')
+  parser.add_argument('--build-workers', default=1, type=int,
+            help='number of processes used to build features, conversations are sharded across them')
+  parser.add_argument('--build-chunksize', default=16, type=int,
+            help='number of conversations sent to a feature building worker at a time')
 
   # ------ PARAMETER OPTIMIZATION --------
   param_group = parser.add_argument_group(title='hyperparameters')
@@ -66,6 +125,18 @@ def solicit_params():
             help='weight_decay to regularize the weights')
   param_group.add_argument('--batch-size', default=50, type=int,
             help='batch size for training and evaluation')
+  param_group.add_argument('--bucket-batches', default=False, action='store_true',
+            help='group examples of similar length into batches to reduce padding')
+  param_group.add_argument('--bucket-size', default=100, type=int,
+            help='number of batches within each window that is sorted by length when bucketing')
+  param_group.add_argument('--static-padding', default=False, action='store_true',
+            help='pad every batch to max-seq-len rather than to its longest example')
+  param_group.add_argument('--precision', default='fp32', choices=['fp32', 'bf16', 'fp16'],
+            help='numeric precision of the encoder forward passes, fp16 also enables loss scaling')
+  param_group.add_argument('--num-workers', default=0, type=int,
+            help='number of background processes that prepare batches, 0 loads them in the main process')
+  param_group.add_argument('--prefetch-factor', default=2, type=int,
+            help='number of batches each background worker prepares in advance')
   param_group.add_argument('-e', '--epochs', default=14, type=int,
             help='Number of epochs or episodes to train')
 
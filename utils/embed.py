@@ -1,26 +1,240 @@
+""" Embeds every candidate utterance in utterances.json into a single matrix, which is written
+as a .npy file that can be memory mapped along with a json manifest describing it.  Examples:
+  PYTHONPATH=. python utils/embed.py --model-type roberta
+  PYTHONPATH=. python utils/embed.py --num-shards 4 --shard-id 0   (and likewise for 1, 2, 3)
+Each shard saves its progress as it goes, so rerunning the same command resumes where it left
+off.  Whichever shard finishes last merges them all, or run again with --merge to merge by hand.
+Only one process can hold the merge lock at a time, so shards finishing together never race.
+Utterances which were already embedded by the same model are reused rather than being embedded
+again, so only new candidates need to pass through the encoder. """
+
+import os, sys, pdb
 import json
-import random
+import time
+import socket
+import hashlib
+import numpy as np
 import torch
 
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
 from tqdm import tqdm as progress_bar
 from transformers import BertTokenizer, BertModel, RobertaTokenizer, RobertaModel
+from transformers import AlbertTokenizer, AlbertModel
+
+encoders = {
+  'bert': (BertTokenizer, BertModel, 'bert-base-uncased'),
+  'roberta': (RobertaTokenizer, RobertaModel, 'roberta-base'),
+  'albert': (AlbertTokenizer, AlbertModel, 'albert-base-v2'),
+}
+
+def solicit_embed_params():
+  parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+  parser.add_argument('--model-type', choices=list(encoders.keys()), default='bert',
+            help='which type of encoder and tokenizer to embed the utterances with')
+  parser.add_argument('--input-dir', default='data/', type=str)
+  parser.add_argument('--output-name', default='utt_vectors', type=str,
+            help='name of the matrix and manifest that are written into the input dir')
+  parser.add_argument('--batch-size', default=64, type=int)
+  parser.add_argument('--max-length', default=128, type=int,
+            help='maximum number of tokens kept for each utterance')
+  parser.add_argument('--dtype', default='fp32', choices=['fp32', 'fp16'],
+            help='precision of the stored vectors')
+  parser.add_argument('--num-shards', default=1, type=int,
+            help='number of processes the utterances are split across')
+  parser.add_argument('--shard-id', default=0, type=int,
+            help='which shard this process is responsible for embedding')
+  parser.add_argument('--save-every', default=20, type=int,
+            help='number of batches between saving progress')
+  parser.add_argument('--merge', default=False, action='store_true',
+            help='skip embedding and only merge the finished shards into the final matrix')
+  return parser.parse_args()
+
+def text_key(text):
+  return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def output_paths(args):
+  prefix = os.path.join(args.input_dir, args.output_name)
+  shard = f'{prefix}.shard{args.shard_id}of{args.num_shards}'
+  return {'matrix': f'{prefix}.npy', 'manifest': f'{prefix}.json',
+          'shard': f'{shard}.npy', 'progress': f'{shard}.json', 'lock': f'{prefix}.merge.lock'}
+
+def find_reusable(args, paths, utt_texts):
+  # rows of a previous bank embedded by the same model which can be copied over as is
+  if not os.path.exists(paths['manifest']):
+    return {}
+  manifest = json.load(open(paths['manifest'], 'r'))
+  if manifest['model_type'] != args.model_type:
+    return {}
+  previous = {key: row for row, key in enumerate(manifest['keys'])}
+  return {idx: previous[text_key(text)] for idx, text in enumerate(utt_texts)
+                if text_key(text) in previous}
+
+def plan_shard(args, tokenizer, utt_texts, reusable):
+  # sort by length so each batch holds similar sized utterances, then deal them out round robin
+  pending = [idx for idx in range(len(utt_texts)) if idx not in reusable]
+  lengths = [len(tokenizer.tokenize(utt_texts[idx])) for idx in pending]
+  ordered = [pending[position] for position in np.argsort(lengths, kind='stable')]
+  return ordered[args.shard_id::args.num_shards]
+
+def embed_shard(args, paths, utt_texts, shard_rows, tokenizer, model, device):
+  hidden_dim = model.config.hidden_size
+  dtype = np.float16 if args.dtype == 'fp16' else np.float32
+  num_batches = (len(shard_rows) + args.batch_size - 1) // args.batch_size
+  progress = {'model_type': args.model_type, 'rows': shard_rows, 'completed': 0}
+
+  if os.path.exists(paths['progress']):
+    previous = json.load(open(paths['progress'], 'r'))
+    if previous['model_type'] == args.model_type and previous['rows'] == shard_rows:
+      progress = previous
+      print(f"Resuming shard {args.shard_id} from batch {progress['completed']} of {num_batches}")
+  if progress['completed'] == 0:
+    vectors = np.lib.format.open_memmap(paths['shard'], mode='w+', dtype=dtype,
+                                          shape=(len(shard_rows), hidden_dim))
+  else:
+    vectors = np.load(paths['shard'], mmap_mode='r+')
+
+  for batch_id in progress_bar(range(progress['completed'], num_batches), total=num_batches,
+                                  initial=progress['completed']):
+    start = batch_id * args.batch_size
+    batch_texts = [utt_texts[idx] for idx in shard_rows[start:start + args.batch_size]]
+    inputs = tokenizer(batch_texts, padding=True, truncation=True, max_length=args.max_length,
+                          return_tensors='pt').to(device)
+    with torch.no_grad():
+      outputs = model(**inputs)
+    vectors[start:start + len(batch_texts)] = outputs.pooler_output.cpu().numpy().astype(dtype)
+
+    progress['completed'] = batch_id + 1
+    if progress['completed'] % args.save_every == 0:
+      save_progress(paths, vectors, progress)
+
+  save_progress(paths, vectors, progress)
+  return progress['completed'] == num_batches
+
+def save_progress(paths, vectors, progress):
+  vectors.flush()   # vectors must reach the disk before the progress claiming them does
+  json.dump(progress, open(paths['progress'] + '.tmp', 'w'))
+  os.replace(paths['progress'] + '.tmp', paths['progress'])
+
+def merge_shards(args, paths, utt_texts, reusable, hidden_dim):
+  """ Once every shard is complete, gather their rows along with the reused rows into the
+  final matrix.  Safe to call from any shard, since it does nothing until all are done and
+  only the process holding the merge lock goes ahead. """
+  # creating the lock file fails if it already exists, so exactly one process holds it.  A shard
+  # which finds it taken waits its turn, since the holder may have checked before this shard finished
+  waiting = False
+  while True:
+    try:
+      lock = os.open(paths['lock'], os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+      break
+    except FileExistsError:
+      if break_stale_lock(paths['lock']):
+        continue
+      if not waiting:
+        print(f"Waiting on the merge holding {paths['lock']}")
+        waiting = True
+      time.sleep(1)
+  try:
+    os.write(lock, f'{socket.gethostname()} {os.getpid()}'.encode('utf-8'))
+    return merge_locked(args, paths, utt_texts, reusable, hidden_dim)
+  finally:
+    os.close(lock)
+    os.remove(paths['lock'])
+
+def break_stale_lock(lock_path, grace=60):
+  """ Removes a lock left behind by a merge which was killed, judged by whether the process
+  named in it is still running.  Locks taken on another host can't be checked that way, and
+  neither can one whose holder has yet to write its pid, so those only count as stale once
+  they are older than the grace period in seconds.  Returns whether the lock is gone. """
+  try:
+    holder = open(lock_path, 'r').read().split()
+    age = time.time() - os.path.getmtime(lock_path)
+  except FileNotFoundError:
+    return True     # released in the meantime, so just try again
+
+  if len(holder) == 2 and holder[0] == socket.gethostname():
+    try:
+      os.kill(int(holder[1]), 0)    # signal 0 only checks that the process exists
+      return False
+    except ProcessLookupError:
+      pass
+    except PermissionError:         # running, but as another user
+      return False
+  elif age < grace:
+    return False
+
+  try:
+    os.remove(lock_path)
+    print(f"Removed the stale lock {lock_path} left by {' '.join(holder) or 'an unknown process'}")
+  except FileNotFoundError:
+    pass
+  return True
+
+def merge_locked(args, paths, utt_texts, reusable, hidden_dim):
+  shard_paths = []
+  for shard_id in range(args.num_shards):
+    prefix = os.path.join(args.input_dir, args.output_name)
+    shard = f'{prefix}.shard{shard_id}of{args.num_shards}'
+    if not os.path.exists(f'{shard}.json'):
+      return False
+    progress = json.load(open(f'{shard}.json', 'r'))
+    num_batches = (len(progress['rows']) + args.batch_size - 1) // args.batch_size
+    if progress['completed'] < num_batches:
+      return False
+    shard_paths.append((shard, progress['rows']))
+
+  covered = sorted(list(reusable.keys()) + [row for _, rows in shard_paths for row in rows])
+  if covered != list(range(len(utt_texts))):
+    raise ValueError("The shards were planned against different banks, rerun every shard to embed them again")
+
+  dtype = np.float16 if args.dtype == 'fp16' else np.float32
+  temp_matrix = paths['matrix'] + '.tmp.npy'
+  merged = np.lib.format.open_memmap(temp_matrix, mode='w+', dtype=dtype,
+                                        shape=(len(utt_texts), hidden_dim))
+  if len(reusable) > 0:
+    previous = np.load(paths['matrix'], mmap_mode='r')
+    targets = np.array(list(reusable.keys()))
+    merged[targets] = previous[np.array(list(reusable.values()))].astype(dtype)
+  for shard, rows in shard_paths:
+    if len(rows) > 0:
+      merged[np.array(rows)] = np.load(f'{shard}.npy', mmap_mode='r')
+  merged.flush()
+  del merged
+
+  # the old manifest goes first, so a crash part way never pairs it with the new matrix
+  manifest = {'model_type': args.model_type, 'dtype': args.dtype, 'hidden_dim': hidden_dim,
+              'num_utterances': len(utt_texts), 'keys': [text_key(text) for text in utt_texts]}
+  json.dump(manifest, open(paths['manifest'] + '.tmp', 'w'))
+  if os.path.exists(paths['manifest']):
+    os.remove(paths['manifest'])
+  os.replace(temp_matrix, paths['matrix'])
+  os.replace(paths['manifest'] + '.tmp', paths['manifest'])
 
-tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
-model = BertModel.from_pretrained('bert-base-uncased')
+  # shard files are only removed once the merged matrix and its manifest are both in place
+  for shard, rows in shard_paths:
+    for leftover in [f'{shard}.npy', f'{shard}.json']:
+      if os.path.exists(leftover):
+        os.remove(leftover)
+  return True
 
-print("Loading data ...")
-utt_texts = json.load(open(f'data/utterances.json', 'r'))
-num_cands = len(utt_texts)
-utt_vectors = []
+if __name__ == "__main__":
+  args = solicit_embed_params()
+  device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+  paths = output_paths(args)
 
-cand_embeds, cand_segments, cand_masks = [], [], []
-for cand_text in progress_bar(utt_texts, total=num_cands):
-  cand_inputs = tokenizer(cand_text, return_tensors="pt")
-  with torch.no_grad():
-	  cand_outputs = model(**cand_inputs)
-  utt_vectors.append(cand_outputs.pooler_output)
+  print("Loading data ...")
+  utt_texts = json.load(open(os.path.join(args.input_dir, 'utterances.json'), 'r'))
+  tokenizer_class, model_class, pretrained_name = encoders[args.model_type]
+  tokenizer = tokenizer_class.from_pretrained(pretrained_name)
+  model = model_class.from_pretrained(pretrained_name).to(device)
+  model.eval()
 
-utt_vectors = torch.cat(utt_vectors)
-print("utt_vectors: {}".format(utt_vectors.shape))
-torch.save(utt_vectors, 'data/utt_vectors.pt')
+  reusable = find_reusable(args, paths, utt_texts)
+  if not args.merge:
+    shard_rows = plan_shard(args, tokenizer, utt_texts, reusable)
+    print(f"Reusing {len(reusable)} vectors, shard {args.shard_id} embeds {len(shard_rows)} utterances")
+    embed_shard(args, paths, utt_texts, shard_rows, tokenizer, model, device)
 
+  if merge_shards(args, paths, utt_texts, reusable, model.config.hidden_size):
+    print(f"utt_vectors: {(len(utt_texts), model.config.hidden_size)} saved to {paths['matrix']}")
+  else:
+    print(f"Shard {args.shard_id} is done, waiting on the remaining shards before merging")
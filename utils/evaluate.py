@@ -11,298 +11,53 @@ from torch.utils.data import DataLoader
 from collections import defaultdict, OrderedDict, Counter
 from sklearn.metrics import accuracy_score
 
-from components.systems import Application
+from components.systems import KBConstraints
+from components.retrieval import top_k
 from utils.help import prepare_inputs
 from utils.load import load_guidelines
 
-def ast_report(predictions, labels):
-  bslot_preds, value_preds = predictions
-  bslot_labels, value_labels = labels
-
-  size = len(bslot_preds)
-  assert(size == len(value_labels))
-
-  top_bslot_preds = np.argmax(bslot_preds, axis=1)
-  bslot_match = bslot_labels == top_bslot_preds   # array of booleans
-  bslot_acc = sum(bslot_match) / float(size) 
-
-  top_value_preds = np.argmax(value_preds, axis=1)
-  value_match = value_labels == top_value_preds
-  value_acc = sum(value_match) / float(size) 
-
-  joint_match = bslot_match & value_match
-  joint_acc = sum(joint_match) / float(size) 
-
-  full_result = {'Bslot_Accuracy': round(bslot_acc, 4),
-          'Value_Accuracy': round(value_acc, 4),
-          'Joint_Accuracy': round(joint_acc, 4),}
-
-  return full_result, 'Joint_Accuracy'
-
-def ranking_report(predictions, labels, use_match=False):
-  full_result = {}
-  utt_match = []
-
-  for rank in [1,5,10]:
-    level = -rank   # select the top 5 rather than bottom 5
-    num_correct, num_possible = 0, 0
-    # vectorized version possible, but a lot less readable
-    for pred, label in zip(predictions, labels):
-      top_k_indexes = np.argpartition(pred, kth=level)[level:]
-      if label in top_k_indexes:
-        num_correct += 1
-        if rank == 1:
-          utt_match.append(True)
-      else:
-        if rank == 1:
-          utt_match.append(False)
-
-      if label >= 0:    # -1 means the turn was take-action or end-of-convo
-        num_possible += 1
-
-    rank_name = f'Recall_at_{rank}'
-    full_result[rank_name] = num_correct / num_possible
-
-  if use_match:
-    return full_result, utt_match
-  else:
-    return full_result, 'Recall_at_5'
-
-def cds_report(predictions, labels, ci_and_tc, kb_labels=None):
-  """ Calculated in the form of cascaded evaluation
-  where each agent example or utterance a scored example"""
-  intent_pred, nextstep_pred, bslot_pred, value_pred, utterance_rank = predictions
-  intent_label, nextstep_label, bslot_label, value_label, utterance_label = labels
-  convo_ids = ci_and_tc[0].detach().cpu().numpy()
-  turn_counts = ci_and_tc[1].detach().cpu().numpy()
-
-  if kb_labels is None:
-    use_kb = False
-  else:
-    use_kb = True
-    intent_list = kb_labels['intent']
-    action_list = kb_labels['action']
-    guidelines = load_guidelines()
-    action_mask_map, intent_mask_map = Application.prepare_masks(*guidelines)
-
-  num_turns = len(nextstep_pred)
-  assert(num_turns == len(convo_ids))
-
-  top_intent_preds = np.argmax(intent_pred, axis=1)
-  intent_match = intent_label == top_intent_preds   # array of booleans
-  intent_acc = sum(intent_match) / float(num_turns) 
-
-  top_nextstep_preds = np.argmax(nextstep_pred, axis=1)
-  nextstep_match = nextstep_label == top_nextstep_preds   # array of booleans
-  nextstep_acc = sum(nextstep_match) / float(num_turns) 
-
-  if use_kb:
-    intent_masks = []
-    for top_intent in top_intent_preds:
-      intent_name = intent_list[top_intent]
-      # each intent mask should be size of 30 long
-      intent_mask = intent_mask_map[intent_name]
-      intent_masks.append(intent_mask)
-    # now, all non valid actions should go to zero
-    bslot_pred *= np.array(intent_masks)
-
-  top_bslot_preds = np.argmax(bslot_pred, axis=1)
-  bslot_match = bslot_label == top_bslot_preds   # array of booleans
-  num_turns_include_action = sum(bslot_label >= 0)
-  bslot_acc = sum(bslot_match) / float(num_turns_include_action) 
-
-  if use_kb:
-    action_masks = []
-    for top_action in top_bslot_preds:
-      action_name = action_list[top_action]
-      # each action mask should be size of 223 long
-      action_mask = action_mask_map[action_name]
-      action_masks.append(action_mask)
-    # now, all non valid values should go to zero
-    value_pred *= np.array(action_masks)
-
-  top_value_preds = np.argmax(value_pred, axis=1)
-  value_match = value_label == top_value_preds
-  num_turns_include_value = sum(value_label >= 0)
-  value_acc = sum(value_match) / float(num_turns_include_value) 
-
-  joint_match = bslot_match & value_match
-  joint_acc = sum(joint_match) / float(num_turns_include_action) 
-
-  recall, utt_match = {}, []
-  for rank in [1,5,10]:
-    level = -rank   # select the top 5 rather than bottom 5
-    num_correct, num_possible = 0, 0
-    for pred, label in zip(utterance_rank, utterance_label):
-      top_k_indexes = np.argpartition(pred, kth=level)[level:]
-      if label in top_k_indexes:
-        num_correct += 1
-        if rank == 1:
-          utt_match.append(True)
-      else:
-        if rank == 1:
-          utt_match.append(False)
-
-      if label >= 0:
-        num_possible += 1
-    recall[str(rank)] = num_correct / num_possible 
-
-  # group by convo_ids
-  unique_convo_ids = list(set(convo_ids))
-  conversations = {}
-  for uci in unique_convo_ids:
-    turns, correctness = [], []
-    row_id = 0
-    for convo_id, turn_count in zip(convo_ids, turn_counts):
-      if convo_id == uci:
-        turns.append(turn_count)
-
-        correct = False
-        intent_right = intent_match[row_id]
-        nextstep_right = nextstep_match[row_id]
-
-        if nextstep_label[row_id] == 0:
-          if intent_right and nextstep_right and utt_match[row_id]:
-            correct = True
-        elif nextstep_label[row_id] == 1:
-          if intent_right and nextstep_right and joint_match[row_id]:
-            correct = True
-        elif nextstep_label[row_id] == 2:
-          if intent_right and nextstep_right:
-            correct = True
-
-        correctness.append(correct)
-      row_id += 1
-
-    # sort by turn_counts
-    ordered = [cor for _, cor in sorted( zip(turns,correctness), key=lambda tc: tc[0] )]
-    conversations[uci] = ordered
-
-  # count how many correct
-  turn_score, turn_correct = 0, 0
-  for convo_id, convo_correctness in conversations.items():
-    convo_length = len(convo_correctness)
-    # we use turn_id rather than the true turn_count since turn counts will skip numbers
-    # when looping through the conversation due to skipping over customer utterances
-    for turn_id in range(convo_length):
-      num_remaining = convo_length - turn_id
-      
-      num_correct = 0
-      # count up how many were predicted correctly
-      while turn_id < convo_length and convo_correctness[turn_id]:
-        num_correct += 1
-        turn_id += 1
-
-      if num_correct > 0:
-        turn_correct += 1
-      # normalize by the number of turns remaining
-      turn_score += num_correct / num_remaining
-
-  # normalize by total number of turns possible
-  turn_acc = turn_correct / float(num_turns)
-  final_score = turn_score / float(num_turns)
-
-  full_result = {'Intent_Accuracy': round(intent_acc, 4),
-         'Nextstep_Accuracy': round(nextstep_acc, 4),
-           'Action_Accuracy': round(bslot_acc, 4),
-          'Value_Accuracy': round(value_acc, 4),
-          'Joint_Accuracy': round(joint_acc, 4),
-             'Recall_at_1': round(recall['1'], 4),
-             'Recall_at_5': round(recall['5'], 4),
-            'Recall_at_10': round(recall['10'], 4),
-           'Turn_Accuracy': round(turn_acc, 4),
-           'Cascading_Score': round(final_score, 4) }
-
-  return full_result, 'Cascading_Score'
-
-def task_completion_report(predictions, labels, kb_labels=None):
-  intent_pred, nextstep_pred, bslot_pred, value_pred, utterance_rank = predictions
-  intent_label, nextstep_label, bslot_label, value_label, utterance_label = labels
-  num_turns = len(nextstep_pred)
-
-  if kb_labels is None:
-    use_kb = False
-  else:
-    use_kb = True
-    intent_list = kb_labels['intent']
-    action_list = kb_labels['action']
-    guidelines = load_guidelines()
-    action_mask_map, intent_mask_map = Application.prepare_masks(*guidelines)
-
-  top_intent_preds = np.argmax(intent_pred, axis=1)
-  intent_match = intent_label == top_intent_preds   # array of booleans
-  intent_acc = sum(intent_match) / float(num_turns) 
-
-  top_nextstep_preds = np.argmax(nextstep_pred, axis=1)
-  nextstep_match = nextstep_label == top_nextstep_preds   # array of booleans
-  nextstep_acc = sum(nextstep_match) / float(num_turns) 
-
-  if use_kb:
-    intent_masks = []
-    for top_intent in top_intent_preds:
-      intent_name = intent_list[top_intent]
-      # each intent mask should be size of 30 long
-      intent_mask = intent_mask_map[intent_name]
-      intent_masks.append(intent_mask)
-    # now, all non valid actions should go to zero
-    bslot_pred *= np.array(intent_masks)
-
-  top_bslot_preds = np.argmax(bslot_pred, axis=1)
-  bslot_match = bslot_label == top_bslot_preds   # array of booleans
-  num_turns_include_action = sum(bslot_label >= 0) 
-  bslot_acc = sum(bslot_match) / float(num_turns_include_action) 
-
-  if use_kb:
-    action_masks = []
-    for top_action in top_bslot_preds:
-      action_name = action_list[top_action]
-      # each action mask should be size of 223 long
-      action_mask = action_mask_map[action_name]
-      action_masks.append(action_mask)
-    # now, all non valid values should go to zero
-    value_pred *= np.array(action_masks)
-
-  top_value_preds = np.argmax(value_pred, axis=1)
-  value_match = value_label == top_value_preds
-  num_turns_include_value = sum(value_label >= 0)
-  value_acc = sum(value_match) / float(num_turns_include_value) 
-
-  joint_match = bslot_match & value_match
-  joint_acc = sum(joint_match) / float(num_turns_include_action) 
-
-  recall, utt_match = ranking_report(utterance_rank, utterance_label, use_match=True)
-
-  assert(num_turns == len(value_label))
-  assert(len(intent_pred) == len(nextstep_label))
-  assert(len(utt_match) == num_turns)    
-  assert(len(bslot_match) == len(top_value_preds))  
-
-  turn_correct = 0
-  for turn in range(num_turns):
-    if intent_match[turn] and nextstep_match[turn]:
-      pass
-    else:
-      continue
-
-    if nextstep_label[turn] == 0 and utt_match[turn]:
-      turn_correct += 1
-    elif nextstep_label[turn] == 1 and joint_match[turn]:
-      turn_correct += 1
-    elif nextstep_label[turn] == 2:      # end_conversation
-      turn_correct += 1
-  turn_acc = turn_correct / float(num_turns)
-
-  full_result = {'Intent_Accuracy': round(intent_acc, 4),
-         'Nextstep_Accuracy': round(nextstep_acc, 4),
-           'Action_Accuracy': round(bslot_acc, 4),
-          'Value_Accuracy': round(value_acc, 4),
-          'Joint_Accuracy': round(joint_acc, 4),
-             'Recall_at_1': round(recall['Recall_at_1'], 4),
-             'Recall_at_5': round(recall['Recall_at_5'], 4),
-            'Recall_at_10': round(recall['Recall_at_10'], 4),
-           'Turn_Accuracy': round(turn_acc, 4) }
-
-  return full_result, 'Turn_Accuracy' 
+def kb_constraints(kb_labels, cache_dir):
+  # compiled once by run_main, otherwise read from the cache that compiling leaves behind
+  if 'constraints' not in kb_labels:
+    kb_labels['constraints'] = KBConstraints.load(kb_labels['intent'], kb_labels['action'],
+                                                    load_guidelines(), cache_dir)
+  return kb_labels['constraints']
+
+def label_ranks(predictions, labels):
+  """ Position of each label within its row of scores, found by counting the candidates
+  which scored strictly higher, so ties are resolved in favor of the label.  Rows without
+  a label (-1) are ranked past the last candidate, and so never count as a match. """
+  predictions, labels = np.asarray(predictions), np.asarray(labels)
+  has_label = labels >= 0
+  label_scores = np.take_along_axis(predictions, np.where(has_label, labels, 0)[:, None], axis=1)
+  ranks = (predictions > label_scores).sum(axis=1)
+  return np.where(has_label, ranks, predictions.shape[1])
+
+def ratio(numerator, denominator):
+  # a single training batch may hold no turns with an action or value, which scores as nan
+  return round(numerator / float(denominator), 4) if denominator > 0 else float('nan')
+
+def cascade_scores(convo_ids, turn_counts, correctness):
+  """ Groups the turns by conversation with a single sort, then scores each turn by the
+  streak of correct turns starting from it, normalized by the number of turns remaining in
+  its conversation.  We use the position within the sorted conversation rather than the true
+  turn_count since turn counts will skip numbers due to skipping over customer utterances.
+  Returns the number of turns starting a streak and the summed streak scores. """
+  order = np.lexsort((turn_counts, convo_ids))    # by conversation, then by turn, ties kept in order
+  correct = np.asarray(correctness, dtype=bool)[order]
+  sorted_convos = np.asarray(convo_ids)[order]
+  num_turns = len(correct)
+  positions = np.arange(num_turns)
+
+  # index one past the last turn of the conversation each turn belongs to
+  is_last = np.append(sorted_convos[1:] != sorted_convos[:-1], True)
+  convo_ends = np.minimum.accumulate(np.where(is_last, positions + 1, num_turns)[::-1])[::-1]
+  # index of the first incorrect turn at or after each turn, which ends the streak
+  first_wrong = np.minimum.accumulate(np.where(correct, num_turns, positions)[::-1])[::-1]
+
+  streaks = np.minimum(first_wrong, convo_ends) - positions
+  num_remaining = convo_ends - positions
+  return int(correct.sum()), float((streaks / num_remaining).sum())
 
 def qualify(args, ids, tokenizer, target_maps, scores, targets):
   history_ids, context_ids = ids
@@ -347,37 +102,193 @@ def qualify(args, ids, tokenizer, target_maps, scores, targets):
 
   pdb.set_trace()  
 
+class MetricAccumulator(object):
+  """ Streams over the evaluation batches, reducing the scores of each one to the counts of
+  correct predictions that the metrics are built from, so memory does not grow with the size
+  of the split.  Cascading evaluation additionally keeps one correctness bit per turn along
+  with its convo_id and turn_count, since streaks can only be scored once every turn of a
+  conversation has been seen.  This is the only place the metrics are computed, whether for
+  a single training batch, a whole split or a rescoring of saved predictions.
+
+  Each batch is first reduced to one compact record per turn, holding the argmaxes, the rank
+  of the utterance label and the raw action and value scores which the KB masks apply to.
+  Records can be saved and tallied again later under different --use-kb or --cascade flags. """
+  utt_top_k = 10
+
+  def __init__(self, args, kb_labels=None, cascade=None):
+    self.task = args.task
+    self.cascade = args.cascade if cascade is None else cascade
+    cache_dir = os.path.join(args.input_dir, 'cache')   # where build_kb_labels compiles them
+    self.constraints = kb_constraints(kb_labels, cache_dir) if args.use_kb and kb_labels else None
+    self.levels = (1, 5, 10)
+    self.counts = Counter()
+    self.num_batches = 0
+    self.correctness, self.convo_ids, self.turn_counts = [], [], []
+
+  @staticmethod
+  def to_numpy(tensors):
+    return [t.detach().cpu().numpy() if torch.is_tensor(t) else np.asarray(t) for t in tensors]
+
+  def record_dtype(self, num_actions, num_values):
+    fields = [('action_scores', np.float32, (num_actions,)), ('action_label', np.int16),
+              ('value_scores', np.float32, (num_values,)), ('value_label', np.int16)]
+    if self.task == 'cds':
+      fields += [('intent_pred', np.int16), ('intent_label', np.int16),
+                 ('nextstep_pred', np.int8), ('nextstep_label', np.int8),
+                 ('utt_rank', np.int16), ('utt_label', np.int16),
+                 ('utt_top', np.int16, (self.utt_top_k,)), ('utt_top_scores', np.float32, (self.utt_top_k,)),
+                 ('convo_id', np.int32), ('turn_count', np.int16)]
+    return np.dtype(fields)
+
+  def add(self, predictions, labels, convo_ids=None, turn_counts=None):
+    records = self.reduce(predictions, labels, convo_ids, turn_counts)
+    self.tally(records)
+    return records
+
+  def reduce(self, predictions, labels, convo_ids=None, turn_counts=None):
+    predictions, labels = self.to_numpy(predictions), self.to_numpy(labels)
+    bslot_pred, value_pred = predictions[-3:-1] if self.task == 'cds' else predictions
+    bslot_label, value_label = labels[-3:-1] if self.task == 'cds' else labels
+
+    records = np.zeros(len(bslot_label), dtype=self.record_dtype(bslot_pred.shape[1], value_pred.shape[1]))
+    records['action_scores'], records['action_label'] = bslot_pred, bslot_label
+    records['value_scores'], records['value_label'] = value_pred, value_label
+    if self.task == 'ast':
+      return records
+
+    intent_pred, nextstep_pred, utterance_rank = predictions[0], predictions[1], predictions[4]
+    records['intent_pred'], records['intent_label'] = np.argmax(intent_pred, axis=1), labels[0]
+    records['nextstep_pred'], records['nextstep_label'] = np.argmax(nextstep_pred, axis=1), labels[1]
+    records['utt_rank'], records['utt_label'] = label_ranks(utterance_rank, labels[4]), labels[4]
+
+    num_top = min(self.utt_top_k, utterance_rank.shape[1])
+    positions = np.broadcast_to(np.arange(utterance_rank.shape[1]), utterance_rank.shape)
+    top_scores, top_ids = top_k(utterance_rank, positions, num_top)
+    records['utt_top'], records['utt_top_scores'] = -1, -np.inf
+    records['utt_top'][:, :num_top], records['utt_top_scores'][:, :num_top] = top_ids, top_scores
+    if convo_ids is not None:
+      records['convo_id'], records['turn_count'] = self.to_numpy([convo_ids, turn_counts])
+    return records
+
+  def tally(self, records):
+    self.num_batches += 1
+    bslot_pred, value_pred = records['action_scores'], records['value_scores']
+    bslot_label, value_label = records['action_label'], records['value_label']
+
+    if self.task == 'ast':
+      bslot_match = bslot_label == np.argmax(bslot_pred, axis=1)
+      value_match = value_label == np.argmax(value_pred, axis=1)
+      self.counts.update({'turns': len(bslot_label), 'bslot': int(bslot_match.sum()),
+            'value': int(value_match.sum()), 'joint': int((bslot_match & value_match).sum())})
+      return
+
+    intent_match = records['intent_label'] == records['intent_pred']
+    nextstep_match = records['nextstep_label'] == records['nextstep_pred']
+    nextstep_label = records['nextstep_label']
+
+    if self.constraints is not None:   # all non valid actions for the predicted intent go to zero
+      bslot_pred = self.constraints.mask_actions(records['intent_pred'], bslot_pred)
+    top_bslot_preds = np.argmax(bslot_pred, axis=1)
+    bslot_match = bslot_label == top_bslot_preds
+
+    if self.constraints is not None:   # all non valid values for the predicted action go to zero
+      value_pred = self.constraints.mask_values(top_bslot_preds, value_pred)
+    value_match = value_label == np.argmax(value_pred, axis=1)
+    joint_match = bslot_match & value_match
+
+    ranks = records['utt_rank']
+    utt_match = ranks < 1
+    correctness = intent_match & nextstep_match & (((nextstep_label == 0) & utt_match) |
+                    ((nextstep_label == 1) & joint_match) | (nextstep_label == 2))
+
+    self.counts.update({'turns': len(nextstep_label), 'intent': int(intent_match.sum()),
+          'nextstep': int(nextstep_match.sum()), 'bslot': int(bslot_match.sum()),
+          'value': int(value_match.sum()), 'joint': int(joint_match.sum()),
+          'with_action': int((bslot_label >= 0).sum()), 'with_value': int((value_label >= 0).sum()),
+          'with_utterance': int((records['utt_label'] >= 0).sum()), 'turn_correct': int(correctness.sum())})
+    self.counts.update({f'recall_{level}': int((ranks < level).sum()) for level in self.levels})
+
+    if self.cascade:
+      self.correctness.append(correctness)
+      self.convo_ids.append(np.asarray(records['convo_id']))
+      self.turn_counts.append(np.asarray(records['turn_count']))
+
+  def report(self):
+    counts = self.counts
+    if self.task == 'ast':
+      full_result = {'Bslot_Accuracy': ratio(counts['bslot'], counts['turns']),
+              'Value_Accuracy': ratio(counts['value'], counts['turns']),
+              'Joint_Accuracy': ratio(counts['joint'], counts['turns']),}
+      return full_result, 'Joint_Accuracy'
+
+    full_result = {'Intent_Accuracy': ratio(counts['intent'], counts['turns']),
+           'Nextstep_Accuracy': ratio(counts['nextstep'], counts['turns']),
+             'Action_Accuracy': ratio(counts['bslot'], counts['with_action']),
+            'Value_Accuracy': ratio(counts['value'], counts['with_value']),
+            'Joint_Accuracy': ratio(counts['joint'], counts['with_action'])}
+    for level in self.levels:
+      full_result[f'Recall_at_{level}'] = ratio(counts[f'recall_{level}'], counts['with_utterance'])
+    full_result['Turn_Accuracy'] = ratio(counts['turn_correct'], counts['turns'])
+
+    if not self.cascade:
+      return full_result, 'Turn_Accuracy'
+    turn_correct, turn_score = cascade_scores(np.concatenate(self.convo_ids),
+          np.concatenate(self.turn_counts), np.concatenate(self.correctness))
+    full_result['Cascading_Score'] = ratio(turn_score, counts['turns'])
+    return full_result, 'Cascading_Score'
+
+class PredictionWriter(object):
+  """ Writes the records produced by a MetricAccumulator into a memory mapped .npy file as
+  evaluation streams along, with a json manifest alongside noting how many rows were written
+  and which checkpoint produced them. """
+
+  def __init__(self, path, num_examples, checkpoint_path):
+    self.path = path
+    self.num_examples = num_examples
+    self.checkpoint_path = checkpoint_path
+    self.records = None
+    self.num_rows = 0
+
+  def write(self, records):
+    if self.records is None:   # the record layout is only known once the first scores arrive
+      self.records = np.lib.format.open_memmap(f'{self.path}.npy', mode='w+',
+                                        dtype=records.dtype, shape=(self.num_examples,))
+    self.records[self.num_rows:self.num_rows + len(records)] = records
+    self.num_rows += len(records)
+
+  def close(self, args):
+    if self.records is not None:
+      self.records.flush()
+    manifest = {'task': args.task, 'num_rows': self.num_rows,
+                'checkpoint': checkpoint_fingerprint(self.checkpoint_path)}
+    json.dump(manifest, open(f'{self.path}.json', 'w'), indent=2)
+    print(f"Saved {self.num_rows} predictions to {self.path}.npy")
+
+def checkpoint_fingerprint(checkpoint_path):
+  if not os.path.exists(checkpoint_path):
+    return None
+  stats = os.stat(checkpoint_path)
+  return {'path': checkpoint_path, 'size': stats.st_size, 'modified': stats.st_mtime}
+
+def load_predictions(path, checkpoint_path):
+  manifest = json.load(open(f'{path}.json', 'r'))
+  if manifest['checkpoint'] != checkpoint_fingerprint(checkpoint_path):
+    print(f"Warning: {checkpoint_path} has changed since these predictions were saved")
+  records = np.load(f'{path}.npy', mmap_mode='r')
+  return records[:manifest['num_rows']], manifest
+
 def quantify(args, predictions, labels, utils=None):
   assert len(predictions) == len(labels)
  
   if utils == "train" and not args.verbose:
     return predictions, labels
 
-  if args.task == 'ast':
-    predictions = [pred.detach().cpu().numpy() for pred in predictions]
-    labels = [label.detach().cpu().numpy() for label in labels]
-    report, res_name = ast_report(predictions, labels)
-
-  elif args.task == 'cds':
-    predictions = [pred.detach().cpu().numpy() for pred in predictions]
-    labels = [label.detach().cpu().numpy() for label in labels]
-    kb_labels = utils['kb_labels'] if args.use_kb else None
-
-    if args.cascade:
-      ci_and_tc = utils['ci_and_tc']
-      result = cds_report(predictions, labels, ci_and_tc, kb_labels)
-      report, res_name = result
-    else:
-      report, res_name = task_completion_report(predictions, labels, kb_labels)
-
-  return report, res_name
-
-
-if __name__ == '__main__':
-  class MyModel():
-    def __init__(self):
-      self.utt_vectors = []
-      self.utt_texts = []
-
-  args = {}
-  run_interaction(args, MyModel())
+  # train batches carry no convo ids, so they fall back to the report without cascading
+  cascade = args.cascade and isinstance(utils, dict)
+  kb_labels = utils['kb_labels'] if isinstance(utils, dict) else None
+  accumulator = MetricAccumulator(args, kb_labels, cascade)
+  if cascade:
+    accumulator.add(predictions, labels, *utils['ci_and_tc'])
+  else:
+    accumulator.add(predictions, labels)
+  return accumulator.report()
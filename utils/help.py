@@ -22,6 +22,10 @@ def setup_gpus(args):
         torch.backends.cudnn.benchmark = False
         torch.backends.cudnn.deterministic = True
 
+    if args.precision == 'fp16' and n_gpu == 0:
+        print("Warning: fp16 autocast requires a GPU, falling back to bf16")
+        args.precision = 'bf16'
+
     if args.debug:
         args.epochs = 3
     return args
@@ -32,10 +36,10 @@ def check_cache(args, cache_dir):
     cache_filename += "_cascade"
   if args.use_intent:
     cache_filename += "_intent"
-  cache_path = os.path.join(cache_dir, cache_filename)
+  cache_path = os.path.join(cache_dir, cache_filename + "_columns")
 
-  if os.path.exists(cache_path):
-    print(f"Loading features from cached file {cache_path}")
+  if os.path.exists(os.path.join(cache_path, 'splits.json')):
+    print(f"Loading features from cached directory {cache_path}")
     return cache_path, True
   else:
     print(f"Loading raw data and preparing new features")
@@ -71,10 +75,8 @@ def prepare_inputs(args, batch, speaker_turn=False):
         #           intent   nextstep   action    value     utterance
         targets = [batch[6], batch[7], batch[8], batch[9], batch[10]]
         candidates = batch[11]
-
-        if args.cascade:
-            targets.append(batch[15])   # convo_ids
-            targets.append(batch[16])   # turn_counts
+        # convo_ids and turn_counts in batch[12] and batch[13] are not targets of the loss,
+        # so evaluation reads them straight from the batch
         if args.use_intent:
           tools = candidates, device, batch[6]
         else:
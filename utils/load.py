@@ -1,6 +1,8 @@
 import os, sys, pdb
 import csv
+import gzip
 import json
+import re
 import random
 import math
 import torch
@@ -9,12 +11,105 @@ import numpy as np
 from transformers import BertTokenizer, RobertaTokenizer, AlbertTokenizer
 from components.tools import RAdam, AdamW, get_linear_schedule_with_warmup
     
+
+class JSONStreamReader(object):
+  """ Incrementally decodes JSON values from a text stream, so that only the value currently
+  being parsed (plus one chunk of lookahead) is ever held in memory """
+  whitespace = re.compile(r'[ \t\n\r]*')
+
+  def __init__(self, stream, chunk_size=1 << 20):
+    self.stream = stream
+    self.chunk_size = chunk_size
+    self.decoder = json.JSONDecoder()
+    self.buffer = ''
+    self.pos = 0
+
+  def fill(self):
+    # read at least as much as is currently buffered, so large values are not re-parsed too often
+    chunk = self.stream.read(max(self.chunk_size, len(self.buffer) - self.pos))
+    if not chunk:
+      return False
+    self.buffer = self.buffer[self.pos:] + chunk
+    self.pos = 0
+    return True
+
+  def peek(self):
+    while True:
+      self.pos = self.whitespace.match(self.buffer, self.pos).end()
+      if self.pos < len(self.buffer):
+        return self.buffer[self.pos]
+      if not self.fill():
+        raise ValueError("Unexpected end of JSON stream")
+
+  def expect(self, char):
+    if self.peek() != char:
+      raise ValueError(f"Expected '{char}' in JSON stream but found '{self.buffer[self.pos]}'")
+    self.pos += 1
+
+  def consume(self, char):
+    # skip past the char if it is next in the stream, returns whether it was found
+    found = self.peek() == char
+    if found:
+      self.pos += 1
+    return found
+
+  def decode(self):
+    self.peek()
+    while True:
+      try:
+        value, end = self.decoder.raw_decode(self.buffer, self.pos)
+        break
+      except json.JSONDecodeError:
+        if not self.fill():   # value is split across chunks, so read more and try again
+          raise
+    self.pos = end
+    return value
+
+  def iter_array(self, keep_fields=None):
+    # assumes the opening '[' has already been consumed
+    if self.consume(']'):
+      return
+    while True:
+      item = self.decode()
+      if keep_fields is not None:
+        item = {field: item[field] for field in keep_fields if field in item}
+      yield item
+      if self.consume(']'):
+        return
+      self.expect(',')
+
+def stream_splits(data_path, keep_fields=('convo_id', 'delexed'), chunk_size=1 << 20):
+  """ Lazily parse a raw dump of the form {split: [conversation, ...]}, which may be gzipped.
+  Yields (split, conversations) pairs where conversations is itself a generator, so each
+  split must be consumed before moving onto the next one.  Fields outside of keep_fields
+  (such as 'original' and 'scenario') are dropped as soon as each conversation is parsed. """
+  opener = gzip.open if data_path.endswith('.gz') else open
+  with opener(data_path, 'rt', encoding='utf-8') as stream:
+    reader = JSONStreamReader(stream, chunk_size)
+    reader.expect('{')
+    if reader.consume('}'):
+      return
+
+    while True:
+      split = reader.decode()
+      reader.expect(':')
+      reader.expect('[')
+      conversations = reader.iter_array(keep_fields)
+      yield split, conversations
+      for _ in conversations:  # drain whatever the caller did not read
+        pass
+      if reader.consume('}'):
+        return
+      reader.expect(',')
+
 def load_data(args, already_cached):
   if already_cached:
     return []  # no need to load raw_data since we already have a feature cache
   else:
     data_path = os.path.join(args.input_dir, f"abcd_v{args.version}.json")
-    raw_data = json.load(open(data_path, 'r'))
+    if not os.path.exists(data_path):   # read the compressed release directly
+      data_path += '.gz'
+    raw_data = stream_splits(data_path)
     return raw_data
 
 def load_guidelines():
@@ -25,8 +120,24 @@ def load_guidelines():
 def load_candidates(args):
   # The raw agent utterances that are used as candidates when performing utterance ranking
   utt_texts = json.load(open(f'{args.input_dir}/utterances.json', 'r'))
-  # Vectors already been embedded by BERT.  To embed in some other fashion, use the utt_texts instead
-  utt_vectors = torch.load(f'{args.input_dir}/utt_vectors.pt')
+  # Vectors already been embedded by utils/embed.py.  To embed in some other fashion, use the utt_texts instead
+  manifest_path = f'{args.input_dir}/utt_vectors.json'
+  if os.path.exists(manifest_path):
+    manifest = json.load(open(manifest_path, 'r'))
+    if manifest['num_utterances'] != len(utt_texts):
+      raise ValueError(f"utt_vectors holds {manifest['num_utterances']} rows but there are " +
+          f"{len(utt_texts)} utterances, rerun utils/embed.py to bring it up to date")
+    if manifest['model_type'] != args.model_type:
+      raise ValueError(f"utt_vectors were embedded with {manifest['model_type']} but the model is " +
+          f"{args.model_type}, rerun utils/embed.py --model-type {args.model_type}")
+    matrix = np.load(f'{args.input_dir}/utt_vectors.npy', mmap_mode='r')
+    # copied out of the read only mapping, since the vectors become a buffer of the model
+    utt_vectors = torch.from_numpy(np.array(matrix, dtype=np.float32))
+  else:   # vectors saved by earlier versions of embed.py, which do not record their model
+    utt_vectors = torch.load(f'{args.input_dir}/utt_vectors.pt')
+  if utt_vectors.shape[1] != args.hidden_dim:
+    raise ValueError(f"utt_vectors have {utt_vectors.shape[1]} dimensions but the model expects " +
+        f"a hidden dim of {args.hidden_dim}")
   return utt_texts, utt_vectors
 
 def load_tokenizer(args):
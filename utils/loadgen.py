@@ -0,0 +1,196 @@
+""" Drives the whole dialogue stack with synthetic traffic and reports how it holds up.  Each
+simulated customer replays the customer turns of a conversation from --conversations, which
+are delexicalized against that conversation's scenario and sent through the same MicroBatcher
+used by utils/serve.py, so every turn goes through the CDS model, the KB constraints in
+take_action and utterance retrieval.  For example:
+  PYTHONPATH=. python utils/loadgen.py --task cds --prefix 0524 --filename final --concurrency 32
+  PYTHONPATH=. python utils/loadgen.py --task cds --untrained --arrival-rate 20 --num-conversations 500
+With --sample-scenarios, each customer is instead given a scene from Application.sample_scenario
+and their turns are synthesized by filling the slots of the delexicalized conversation with the
+values of that scene, before being delexicalized against it again.
+By default conversations start as soon as another ends, keeping --concurrency of them open.
+With --arrival-rate, they instead arrive as a poisson process, still capped at --concurrency.
+Everything runs on the cpu and offline, so the encoder must already be in the local cache. """
+
+import os, sys, pdb
+if __name__ == "__main__":   # before transformers is imported, and never when imported elsewhere
+  os.environ.setdefault('HF_HUB_OFFLINE', '1')
+  os.environ.setdefault('TRANSFORMERS_OFFLINE', '1')
+import re
+import json
+import time
+import random
+import asyncio
+import resource
+import numpy as np
+import torch
+
+from utils.arguments import solicit_params
+from utils.help import set_seed, setup_gpus, check_directories
+from utils.load import load_tokenizer, load_candidates
+from utils.process import CDSProcessor
+from utils.serve import load_application
+from components.models import CascadeDialogSuccess
+from components.systems import Application, Delexicalizer
+from components.serving import SessionStore, MicroBatcher
+
+cpu = torch.device('cpu')
+
+def build_application(args, conversations):
+  if not args.untrained:
+    return load_application(args, cpu)
+
+  ckpt_dir, _ = check_directories(args)
+  tokenizer, ontology = load_tokenizer(args)
+  processor = CDSProcessor(args, tokenizer, ontology)
+  model = CascadeDialogSuccess(args, processor.mappers, ckpt_dir)
+  model.encoder.resize_token_embeddings(len(tokenizer))
+  model.eval()
+  try:
+    candidates = load_candidates(args)
+  except FileNotFoundError:   # no embedded bank yet, so retrieve from the agent turns instead
+    utt_texts = sorted({text for convo in conversations for speaker, text in convo['original'] if speaker == 'agent'})
+    candidates = utt_texts, torch.randn(len(utt_texts), args.hidden_dim)
+  model.add_candidate_data(*candidates)
+  return Application(args, model, processor)
+
+def memory_mb():
+  # resident set size right now where /proc is available, otherwise the peak so far
+  try:
+    with open('/proc/self/statm', 'r') as statm:
+      return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+  except (OSError, ValueError):
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def synthesize_turns(convo, scene, non_enumerable):
+  """ The customer turns of a conversation rewritten for another customer, by filling each slot
+  token of the delexicalized text with the value of that slot within the scene.  Returns the
+  delexicalizer of the scene along with the texts, where unknown slots are left as they are. """
+  delexicalizer = Delexicalizer.from_scene(scene, non_enumerable)
+  values = {}
+  for value, slot in delexicalizer.slots.items():
+    values.setdefault(slot, value)
+  fill = lambda match: values.get(match.group(1), match.group(0))
+  texts = [re.sub(r'<(\w+)>', fill, turn['text']) for turn in convo['delexed'] if turn['speaker'] == 'customer']
+  return delexicalizer, texts
+
+def percentiles(latencies):
+  if len(latencies) == 0:
+    return {'p50_ms': None, 'p95_ms': None, 'p99_ms': None}
+  p50, p95, p99 = np.percentile(np.array(latencies) * 1000, [50, 95, 99])
+  return {'p50_ms': round(float(p50), 2), 'p95_ms': round(float(p95), 2), 'p99_ms': round(float(p99), 2)}
+
+class LoadTest(object):
+  """ Runs the simulated conversations while recording the latency of every customer turn, from
+  delexicalizing its text to the reply coming back, and samples progress every report_every
+  seconds.  With sample_scenarios, every session is set up with its own scene just as a
+  simulated customer would be, and the traffic is synthesized from that scene. """
+
+  def __init__(self, args, app, conversations):
+    self.args = args
+    self.app = app
+    self.conversations = conversations
+    self.sessions = SessionStore(app.processor, args.max_sessions, args.session_ttl)
+    self.batcher = MicroBatcher(app, self.sessions, args.serve_batch_size, args.batch_deadline / 1000)
+    self.non_enumerable = app.processor.ontology['values']['non_enumerable']
+    if args.sample_scenarios and not os.path.exists(app.scenario_path):
+      raise FileNotFoundError(f"--sample-scenarios needs the scenarios in {app.scenario_path}")
+    self.rng = random.Random(args.seed)
+
+    self.latencies, self.window = [], []   # every turn, and only those since the last report
+    self.num_errors, self.num_finished = 0, 0
+    self.timeline = []
+
+  async def converse(self, convo_number):
+    session_id = f'load-{convo_number}'
+    convo = self.conversations[self.rng.randrange(len(self.conversations))]
+    if self.args.sample_scenarios:
+      scene, _ = self.app.sample_scenario(self.sessions.get(session_id))
+      delexicalizer, texts = synthesize_turns(convo, scene, self.non_enumerable)
+    else:
+      delexicalizer = Delexicalizer.from_scenario(convo['scenario'], self.non_enumerable)
+      texts = [text for speaker, text in convo['original'] if speaker == 'customer']
+
+    # agent turns and actions come from the model instead
+    for text in texts:
+      start = time.perf_counter()
+      try:
+        await self.batcher.submit(session_id, delexicalizer(text))
+      except Exception as error:
+        self.num_errors += 1
+        print(f"Turn of {session_id} failed: {error}")
+        break
+      latency = time.perf_counter() - start
+      self.latencies.append(latency)
+      self.window.append(latency)
+      if self.args.think_time > 0:
+        await asyncio.sleep(self.args.think_time)
+
+    self.batcher.end_session(session_id)
+    self.num_finished += 1
+
+  async def report(self, started):
+    last = started
+    while True:
+      await asyncio.sleep(self.args.report_every)
+      now = time.perf_counter()
+      window, self.window = self.window, []
+      progress = dict({'elapsed_s': round(now - started, 1), 'turns_per_s': round(len(window) / (now - last), 2),
+                  'finished': self.num_finished, 'open_sessions': len(self.sessions),
+                  'memory_mb': round(memory_mb(), 1)}, **percentiles(window))
+      self.timeline.append(progress)
+      print(' '.join(f'{key}={value}' for key, value in progress.items()))
+      last = now
+
+  async def run(self):
+    self.batcher.start()
+    started = time.perf_counter()
+    reporter = asyncio.get_running_loop().create_task(self.report(started))
+    slots = asyncio.Semaphore(self.args.concurrency)
+
+    async def limited(convo_number):
+      async with slots:
+        await self.converse(convo_number)
+
+    if self.args.arrival_rate > 0:
+      tasks = []
+      for convo_number in range(self.args.num_conversations):
+        tasks.append(asyncio.get_running_loop().create_task(limited(convo_number)))
+        await asyncio.sleep(self.rng.expovariate(self.args.arrival_rate))
+      await asyncio.gather(*tasks)
+    else:
+      await asyncio.gather(*[limited(convo_number) for convo_number in range(self.args.num_conversations)])
+
+    elapsed = time.perf_counter() - started
+    reporter.cancel()
+    await self.batcher.stop()
+
+    batching = self.batcher.stats.summary()
+    summary = dict({'conversations': self.num_finished, 'turns': len(self.latencies), 'errors': self.num_errors,
+                'elapsed_s': round(elapsed, 2), 'turns_per_s': round(len(self.latencies) / elapsed, 2),
+                'conversations_per_s': round(self.num_finished / elapsed, 2),
+                'peak_memory_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+                'mean_batch_size': batching['mean_batch_size'], 'batch_sizes': batching['batch_sizes']},
+                **percentiles(self.latencies))
+    return summary
+
+if __name__ == "__main__":
+  args = solicit_params()
+  args = setup_gpus(args)
+  set_seed(args)
+  if args.task != 'cds':
+    raise ValueError("Only cds models decide what to say next, so load testing requires --task cds")
+
+  conversations = json.load(open(args.conversations, 'r'))
+  if isinstance(conversations, dict):   # a full release split into train, dev and test
+    conversations = [convo for split in conversations.values() for convo in split]
+  torch.set_grad_enabled(False)
+  app = build_application(args, conversations)
+  print(f"Loaded the application using {memory_mb():.1f} MB, replaying {len(conversations)} conversations")
+
+  load_test = LoadTest(args, app, conversations)
+  summary = asyncio.run(load_test.run())
+  for key, value in summary.items():
+    print(f"{key}: {value}")
+  if args.report_path is not None:
+    json.dump({'summary': summary, 'timeline': load_test.timeline}, open(args.report_path, 'w'), indent=2)
@@ -7,18 +7,71 @@ import numpy as np
 import pandas as pd
 import datetime
 
+from multiprocessing import Pool
 from tqdm import tqdm as progress_bar
-from components.datasets import ActionFeature, CompletionFeature, CascadeFeature
-from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
+from utils.help import device
+from components.datasets import ActionFeature, CompletionFeature, CascadeFeature, FeatureColumns
+from components.datasets import BucketBatchSampler
+from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, BatchSampler
 
-def setup_dataloader(datasets, batch_size, split):
+def setup_dataloader(args, datasets, split):
   dataset = datasets[split]
   num_examples = len(dataset)
-  sampler = RandomSampler(dataset) if split == 'train' else SequentialSampler(dataset)
-  collate = dataset.collate_func
-  dataloader = DataLoader(dataset, sampler=sampler, batch_size=batch_size, collate_fn=collate)
+  # the samplers draw from their own generator, so the order of batches only depends on the seed
+  generator = torch.Generator().manual_seed(args.seed)
+  if args.bucket_batches:   # batch together examples of similar length to reduce padding
+    batch_sampler = BucketBatchSampler(dataset.lengths(), args.batch_size, shuffle=split == 'train',
+                                        bucket_size=args.bucket_size, generator=generator)
+  else:
+    sampler = RandomSampler(dataset, generator=generator) if split == 'train' else SequentialSampler(dataset)
+    batch_sampler = BatchSampler(sampler, args.batch_size, drop_last=False)
+  # the dataset builds each batch from the full list of indices, so automatic batching is off
+  loader_options = {'pin_memory': device.type == 'cuda'}
+  if args.num_workers > 0:  # workers hand back batches in sampler order
+    loader_options.update(num_workers=args.num_workers, prefetch_factor=args.prefetch_factor,
+                            persistent_workers=True)
+  dataloader = DataLoader(dataset, sampler=batch_sampler, batch_size=None, **loader_options)
   print(f"Loaded {split} data with {len(dataloader)} batches")
-  return dataloader, num_examples
+  return DevicePrefetcher(dataloader, device), num_examples
+
+class DevicePrefetcher(object):
+  """ Wraps a dataloader to hand back batches that are already on the device.  On a GPU the
+  copy of the next batch is issued on a side stream while the current batch is being used,
+  so the host to device transfer overlaps with compute. """
+
+  def __init__(self, dataloader, device):
+    self.dataloader = dataloader
+    self.device = device
+    self.stream = torch.cuda.Stream() if device.type == 'cuda' else None
+
+  def __len__(self):
+    return len(self.dataloader)
+
+  def transfer(self, batch):
+    return tuple(t.to(self.device, non_blocking=True) for t in batch)
+
+  def preload(self, batches):
+    batch = next(batches, None)
+    if batch is not None:
+      with torch.cuda.stream(self.stream):
+        batch = self.transfer(batch)
+    return batch
+
+  def __iter__(self):
+    if self.stream is None:
+      for batch in self.dataloader:
+        yield self.transfer(batch)
+      return
+
+    batches = iter(self.dataloader)
+    upcoming = self.preload(batches)
+    while upcoming is not None:
+      torch.cuda.current_stream().wait_stream(self.stream)
+      batch = upcoming
+      for tensor in batch:   # prevent the memory from being reused while still in use
+        tensor.record_stream(torch.cuda.current_stream())
+      upcoming = self.preload(batches)
+      yield batch
 
 def notify_feature_sizes(args, features):
   if args.verbose:
@@ -51,6 +104,77 @@ def prepare_value_labels(ontology):
         value_list.append(val.lower())
   return {slotval: idx for idx, slotval in enumerate(value_list)}
 
+class DialogueHistory(object):
+  """ The utterances of one conversation seen so far, stored as 'speaker|text' strings.  Each
+  utterance is tokenized exactly once as it is appended, so the model inputs for any prefix
+  of the conversation are assembled from cached token ids rather than by re-tokenizing the
+  whole joined history at every turn. """
+
+  def __init__(self, processor, intent=None):
+    self.processor = processor
+    self.intent = intent
+    self.utterances = []
+    self.token_ids = []   # all utterances joined by separators, without the outer [CLS] and [SEP]
+
+    # unique tokens in order of first appearance, used as candidates for copying values
+    self.candidate_tokens = []
+    self.candidate_index = {}   # token to its position within candidate_tokens
+    self.num_indexed = 0        # utterances that have been added to the candidates so far
+
+  def __len__(self):
+    return len(self.utterances)
+
+  def append(self, utterance):
+    self.utterances.append(utterance)
+    self.encode(utterance, add_separator=len(self.utterances) > 1)
+
+  def encode(self, utterance, add_separator):
+    effective_max = self.processor.special['maximum'][0]
+    if len(self.token_ids) >= effective_max:
+      return  # the history is already full, so the rest would be truncated anyway
+
+    text = utterance.split('|')[1]  # drop the speaker
+    if self.processor.use_intent:
+      text = f"{self.intent}|{text}"
+    if add_separator:
+      # tokenized along with the separator and the spaces around it, just as in the joined history,
+      # since BPE tokenizers such as RoBERTa's encode a word differently after a space
+      text = f" {self.processor.special['tokens'][1]} {text}"
+    tokens = self.processor.tokenize_text(text)
+    self.token_ids.extend(self.processor.tokenizer.convert_tokens_to_ids(tokens))
+
+  def set_intent(self, intent):
+    # the intent is prepended to every utterance, so switching intents means encoding again
+    if intent != self.intent:
+      self.intent = intent
+      self.token_ids = []
+      for position, utterance in enumerate(self.utterances):
+        self.encode(utterance, add_separator=position > 0)
+
+  def candidate_window(self, size):
+    # returns the most recent unique tokens along with the position of the first one,
+    # utterances are only tokenized the first time a value lookup needs them
+    for utterance in self.utterances[self.num_indexed:]:
+      self.index_candidates(utterance.split('|')[1])
+    self.num_indexed = len(self.utterances)
+
+    start = max(len(self.candidate_tokens) - size, 0)
+    return self.candidate_tokens[start:], start
+
+  def index_candidates(self, text):
+    # each token keeps the position of its first appearance anywhere in the conversation
+    for tok in self.processor.tokenizer.tokenize(text):
+      if len(tok) > 2 and tok not in self.candidate_index:  # remove punctuation and special tokens
+        self.candidate_index[tok] = len(self.candidate_index)
+        self.candidate_tokens.append(tok)
+
+  def embed(self):
+    is_empty = len(self.utterances) == 0 or (len(self.utterances) == 1
+                and not self.processor.use_intent and self.utterances[0].split('|')[1] == '')
+    if is_empty:  # an empty history is represented with a single padding token
+      return self.processor.embed_utterance('', pad=False)
+    return self.processor.embed_token_ids(self.token_ids, pad=False)
+
 class BaseProcessor(object):
 
   def __init__(self, args, tokenizer, ontology):
@@ -77,6 +201,7 @@ class BaseProcessor(object):
       'nextstep': prepare_nextstep_labels(self.ontology)
     }  # utterance is ranking, so not needed
     self.start_idx = len(self.mappers['value'])
+    self.action_sizes = {}  # number of tokens in each action name
 
     # Break down the slot values by action
     self.value_by_action = {}
@@ -99,20 +224,12 @@ class BaseProcessor(object):
     }
 
   def value_to_id(self, context, action, value, potential_vals):
-    # context is a list of utterances
+    # context is a DialogueHistory, whose unique tokens serve as the copy candidates
     target_id = -1
-    action_tokens = self.tokenizer.tokenize(action)
-    filtered = []
-    for utterance in context:
-      speaker, text = utterance.split('|')
-      context_tokens = self.tokenizer.tokenize(text)
-      for tok in context_tokens:
-        if tok in filtered:  continue       # find uniques this way to preserve order
-        if len(tok) > 2:
-          filtered.append(tok)            # remove punctuation and special tokens
-
-    effective_max = 100 - (len(action_tokens) + 3)   # three special tokens will be added
-    tokens = filtered[-effective_max:]             # [CLS] action [SEP] filtered [SEP]
+    if action not in self.action_sizes:
+      self.action_sizes[action] = len(self.tokenizer.tokenize(action))
+    effective_max = 100 - (self.action_sizes[action] + 3)   # three special tokens will be added
+    tokens, start = context.candidate_window(effective_max)  # [CLS] action [SEP] filtered [SEP]
 
     for option in potential_vals:
       if option in self.enumerable:    # just look it up
@@ -120,33 +237,67 @@ class BaseProcessor(object):
           target_id = self.mappers['value'][value]
       else:
         entity = f'<{option}>'       # calculate location in the context
-        if entity in tokens:
-          target_id = self.start_idx + tokens.index(entity)
+        position = context.candidate_index.get(entity, -1)
+        if position >= start:
+          target_id = self.start_idx + position - start
 
       if target_id >= 0: break     # we found our guy, so let's move on
 
     return target_id, tokens
 
-  def build_features(self, args, raw_data):
-    print("Build features method missing")
+  def convo_to_features(self, convo):
+    print("Convo to features method missing")
     raise NotImplementedError()
 
-  def embed_utterance(self, text):
+  def build_features(self, args, raw_data):
+    features = {}
+    pool = Pool(args.build_workers, initializer=init_build_worker, initargs=(self,)) \
+                if args.build_workers > 1 else None
+
+    try:
+      for split, data in raw_data:
+        print(f"Building features for {split}")
+        if pool is None:
+          convo_feats = map(self.convo_to_features, data)
+        else:   # imap hands back results in submission order, so output matches the serial path
+          convo_feats = pool.imap(build_convo_features, data, chunksize=args.build_chunksize)
+
+        split_feats = []
+        total = len(data) if isinstance(data, list) else None   # streamed splits have no length up front
+        for feats in progress_bar(convo_feats, total=total):
+          split_feats.extend(feats)
+        features[split] = split_feats
+    finally:
+      if pool is not None:   # every result has been consumed, or a worker failed and the rest are abandoned
+        pool.terminate()
+        pool.join()
+    return features
+
+  def tokenize_text(self, text):
+    if self.model_type in ['roberta', 'large']:
+      return self.tokenizer.tokenize(text, add_prefix_space=True)
+    else:
+      return self.tokenizer.tokenize(text)
+
+  def embed_utterance(self, text, pad=True):
+    pad_token = self.special['tokens'][2]
+    text = pad_token if text == '' else text
+    tokens = self.tokenize_text(text)
+    return self.embed_token_ids(self.tokenizer.convert_tokens_to_ids(tokens), pad)
+
+  def embed_token_ids(self, token_ids, pad=True):
+    # token_ids are the already tokenized history, which is truncated and wrapped in special tokens
     cls_token, sep_token, pad_token = self.special['tokens']
     cls_token_segment_id, sequence_a_segment_id, pad_token_segment_id = self.special['ids']
     effective_max, max_seq_length = self.special['maximum']
+    cls_token_id, sep_token_id = self.tokenizer.convert_tokens_to_ids([cls_token, sep_token])
 
-    text = pad_token if text == '' else text
-    if self.model_type in ['roberta', 'large']:
-      tokens = self.tokenizer.tokenize(text, add_prefix_space=True)
-    else:
-      tokens = self.tokenizer.tokenize(text)
-    if len(tokens) > effective_max:
-      tokens = tokens[:effective_max]
+    if len(token_ids) > effective_max:
+      token_ids = token_ids[:effective_max]
 
-    tokens = tokens + [sep_token]
-    segment_ids = [cls_token_segment_id] + [sequence_a_segment_id] * len(tokens)
-    tokens = [cls_token] + tokens
+    input_ids = token_ids + [sep_token_id]
+    segment_ids = [cls_token_segment_id] + [sequence_a_segment_id] * len(input_ids)
+    input_ids = [cls_token_id] + input_ids
     # The convention in BERT is:
     # (a) For sequence pairs:
     #  tokens:   [CLS] is this jack ##son ##ville ? [SEP] no it is not . [SEP]
@@ -161,9 +312,10 @@ class BaseProcessor(object):
     # are added to the wordpiece embedding vector (and position vector). Hopefully
     # the fine-tuning can overcome this difference in semantic meaning
 
-    input_ids = self.tokenizer.convert_tokens_to_ids(tokens)
     # The mask has 1 for real tokens and 0 for padding tokens. Only real tokens are attended to.
     input_mask = [1] * len(input_ids)
+    if not pad:   # padding is left to the dataset when batching
+      return input_ids, segment_ids, input_mask
 
     pad_token_id = self.tokenizer.convert_tokens_to_ids([pad_token])[0]
     # Zero-pad up to the sequence length.
@@ -178,7 +330,7 @@ class BaseProcessor(object):
 
     return input_ids, segment_ids, input_mask
 
-  def convert_context_tokens(self, context_tokens):
+  def convert_context_tokens(self, context_tokens, pad=True):
     # context_tokens is a list of pre-tokenized strings, with action name in the front
     # and we want a list of embedded vectors
     cls_token, sep_token, pad_token = self.special['tokens']
@@ -191,6 +343,8 @@ class BaseProcessor(object):
     token_ids = self.tokenizer.convert_tokens_to_ids(tokens)
     # The mask has 1 for real tokens and 0 for padding tokens. Only real tokens are attended to.
     input_mask = [1] * len(token_ids)
+    if not pad:
+      return {'token_ids': token_ids, 'segment_ids': segment_ids, 'mask_ids': input_mask}
 
     pad_token_id = self.tokenizer.convert_tokens_to_ids([pad_token])[0]
     # Zero-pad up to the sequence length.
@@ -209,25 +363,24 @@ class BaseProcessor(object):
     return self.mappers['action'][action]
 
   def convert_example(self, dialog_history, target_ids, context_tokens, intent=None, candidates=None):
-    sep_token = self.special['tokens'][1]
-
-    texts = [utterance.split('|')[1] for utterance in dialog_history]  # drop the speaker
+    # dialog_history is a DialogueHistory holding the conversation up to the current turn
     if self.use_intent:
-      texts = [f"{intent}|{text}" for text in texts]
-    embedded, segments, mask = self.embed_utterance(f' {sep_token} '.join(texts))
+      dialog_history.set_intent(intent)
+    embedded, segments, mask = dialog_history.embed()
 
     if self.task == 'ast':
-      embedded_context = self.convert_context_tokens(context_tokens)
+      embedded_context = self.convert_context_tokens(context_tokens, pad=False)
       feature = ActionFeature(input_ids=embedded, segment_ids=segments, input_mask=mask, 
             label_ids=target_ids, context=embedded_context)
     elif self.task == 'cds':
-      embedded_context = self.convert_context_tokens(context_tokens)
+      embedded_context = self.convert_context_tokens(context_tokens, pad=False)
       feature = CascadeFeature(input_ids=embedded, segment_ids=segments, input_mask=mask, 
             label_ids=target_ids, context=embedded_context, candidates=candidates)
 
     return feature
     
 class ASTProcessor(BaseProcessor):
+  feature_class = ActionFeature
 
   def collect_one_example(self, context, action, value, potential_vals):
     # actions that don't require any values
@@ -260,33 +413,26 @@ class ASTProcessor(BaseProcessor):
     else:
       self.collect_one_example(context, action, 'not applicable', potential_vals)
 
-  def build_features(self, args, raw_data):
-    features = {}
-
-    for split, data in raw_data.items():
-      self.split_feats = []
-      print(f"Building features for {split}")
+  def convo_to_features(self, convo):
+    self.split_feats = []
+    so_far = DialogueHistory(self)
 
-      for convo in progress_bar(data, total=len(data)):
-        so_far = []
+    for turn in convo['delexed']:
+      speaker, utt = turn['speaker'], turn['text']
+      _, _, action, values, _ = turn['targets']
 
-        for turn in convo['delexed']:
-          speaker, utt = turn['speaker'], turn['text']
-          _, _, action, values, _ = turn['targets']
+      if speaker in ['agent', 'customer']:
+        utt_str = f'{speaker}|{utt}'
+        so_far.append(utt_str)
+      else:   # create a training example during every action
+        self.collect_examples(so_far, action, values)
+        action_str = f'action|{action}'
+        so_far.append(action_str)
 
-          if speaker in ['agent', 'customer']:
-            utt_str = f'{speaker}|{utt}'
-            so_far.append(utt_str)
-          else:   # create a training example during every action
-            context = so_far.copy() # [::-1] to reverse
-            self.collect_examples(context, action, values)
-            action_str = f'action|{action}'
-            so_far.append(action_str)
-
-      features[split] = self.split_feats
-    return features
+    return self.split_feats
 
 class CDSProcessor(BaseProcessor):
+  feature_class = CascadeFeature
 
   def collect_one_example(self, dialog_history, targets, support_items):
     intent, nextstep, action, _, utt_id = targets
@@ -332,41 +478,51 @@ class CDSProcessor(BaseProcessor):
     else:
       self.collect_one_example(context, targets, ("not applicable", potential_vals, convo_id, turn_id))
 
-  def build_features(self, args, raw_data):
-    features = {}
+  def convo_to_features(self, convo):
+    self.split_feats = []
+    so_far = DialogueHistory(self)
+
+    for turn in convo['delexed']:
+      speaker, text = turn['speaker'], turn['text']
+      utterance = f"{speaker}|{text}"
+
+      if speaker == 'agent':
+        support_items = turn['candidates'], convo['convo_id'], turn['turn_count']
+        self.collect_one_example(so_far, turn['targets'], support_items)
+        so_far.append(utterance)
+      elif speaker == 'action':
+        self.collect_examples(so_far, turn['targets'], convo['convo_id'], turn['turn_count'])
+        so_far.append(utterance)
+      else:
+        so_far.append(utterance)
 
-    for split, data in raw_data.items():
-      self.split_feats = []
-      print(f"Building features for {split}")
-
-      for convo in progress_bar(data, total=len(data)):
-        so_far = []
-
-        for turn in convo['delexed']:
-          speaker, text = turn['speaker'], turn['text']
-          utterance = f"{speaker}|{text}"
-
-          if speaker == 'agent':
-            context = so_far.copy()
-            support_items = turn['candidates'], convo['convo_id'], turn['turn_count']
-            self.collect_one_example(context, turn['targets'], support_items)
-            so_far.append(utterance)
-          elif speaker == 'action':
-            context = so_far.copy()
-            self.collect_examples(context, turn['targets'], convo['convo_id'], turn['turn_count'])
-            so_far.append(utterance)
-          else:
-            so_far.append(utterance)
-
-        context = so_far.copy()  # the entire conversation
-        end_targets = turn['targets'].copy()
-        end_targets[1] = 'end_conversation'
-        end_targets[4] = -1
-        support_items = convo['convo_id'], turn['turn_count']
-        self.collect_one_example(context, end_targets, support_items)
-
-      features[split] = self.split_feats
-    return features
+    # the entire conversation
+    end_targets = turn['targets'].copy()
+    end_targets[1] = 'end_conversation'
+    end_targets[4] = -1
+    support_items = convo['convo_id'], turn['turn_count']
+    self.collect_one_example(so_far, end_targets, support_items)
+
+    return self.split_feats
+
+def init_build_worker(processor):
+  # each worker process receives its own copy of the processor, including the tokenizer
+  global worker_processor
+  worker_processor = processor
+
+def build_convo_features(convo):
+  return worker_processor.convo_to_features(convo)
+
+def save_features(features, cache_path, tokenizer, feature_class):
+  pad_id = tokenizer.convert_tokens_to_ids(tokenizer.pad_token)
+  for split, feats in features.items():
+    columns = FeatureColumns.from_features(feats, len(tokenizer), pad_id, feature_class)
+    columns.save(os.path.join(cache_path, split))
+  json.dump({'splits': list(features.keys())}, open(os.path.join(cache_path, 'splits.json'), 'w'))
+
+def load_features(cache_path):
+  splits = json.load(open(os.path.join(cache_path, 'splits.json'), 'r'))['splits']
+  return {split: FeatureColumns.load(os.path.join(cache_path, split)) for split in splits}
 
 def process_data(args, tokenizer, ontology, raw_data, cache_path, from_cache):
   # Takes in a pre-processed dataset and performs further operations:
@@ -376,13 +532,13 @@ def process_data(args, tokenizer, ontology, raw_data, cache_path, from_cache):
   elif args.task == 'cds':
     processor = CDSProcessor(args, tokenizer, ontology)
 
-  if from_cache:
-    features = torch.load(cache_path)
-    print(f"Features loaded successfully.")
-  else:
+  if not from_cache:
     features = processor.build_features(args, raw_data)
-    print(f"Saving features into cached file {cache_path}")
-    torch.save(features, cache_path)
-  
+    print(f"Saving features into cached directory {cache_path}")
+    save_features(features, cache_path, tokenizer, processor.feature_class)
+
+  features = load_features(cache_path)
+  print(f"Features loaded successfully.")
+
   notify_feature_sizes(args, features)
   return features, processor.mappers
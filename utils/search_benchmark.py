@@ -0,0 +1,79 @@
+""" Measures the recall@k and latency of the approximate utterance index against brute force
+search over the same bank.  Examples:
+  PYTHONPATH=. python utils/search_benchmark.py
+  PYTHONPATH=. python utils/search_benchmark.py --checkpoint outputs/cds/<folder>/pytorch_model.pt
+With a checkpoint, the bank is projected by its candidate_linear exactly as the model scores
+it, and the queries are passed through its context_linear.  Queries are bank vectors with
+gaussian noise added, which stand in for encoded dialogue histories. """
+
+import os, sys, pdb
+import time
+import numpy as np
+import torch
+
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from utils.load import load_candidates
+from components.retrieval import ExactIndex, IVFPQIndex
+
+def solicit_benchmark_params():
+  parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+  parser.add_argument('--input-dir', default='data/', type=str)
+  parser.add_argument('--model-type', default='bert', choices=['bert', 'roberta', 'albert'],
+            help='encoder the utterance bank is expected to have been embedded with')
+  parser.add_argument('--hidden-dim', default=768, type=int)
+  parser.add_argument('--checkpoint', default=None, type=str,
+            help='saved CDS model whose projection layers are applied to the bank and queries')
+  parser.add_argument('--seed', default=14, type=int)
+  parser.add_argument('--num-queries', default=500, type=int)
+  parser.add_argument('--noise', default=0.1, type=float,
+            help='scale of the noise added to each query, relative to the average vector norm')
+  parser.add_argument('--top-k', default=[1, 5, 10], type=int, nargs='+')
+  parser.add_argument('--num-lists', default=None, type=int)
+  parser.add_argument('--num-probe', default=[1, 4, 8, 16], type=int, nargs='+')
+  parser.add_argument('--pq-subspaces', default=16, type=int)
+  parser.add_argument('--rerank', default=4, type=int)
+  return parser.parse_args()
+
+def project(vectors, state_dict, layer):
+  if state_dict is None:
+    return vectors
+  weight = state_dict[f'{layer}.weight'].float().cpu().numpy()
+  bias = state_dict[f'{layer}.bias'].float().cpu().numpy()
+  return vectors @ weight.T + bias
+
+def timed_search(index, queries, k, **options):
+  start = time.perf_counter()
+  scores, ids = index.search(queries, k, **options)
+  return ids, (time.perf_counter() - start) / len(queries) * 1000
+
+def recall_at_k(found, expected):
+  hits = [len(set(f) & set(e)) for f, e in zip(found.tolist(), expected.tolist())]
+  return sum(hits) / expected.size
+
+if __name__ == "__main__":
+  args = solicit_benchmark_params()
+  rng = np.random.RandomState(args.seed)
+  utt_texts, utt_vectors = load_candidates(args)
+  utt_vectors = utt_vectors.float().numpy()
+  state_dict = torch.load(args.checkpoint, map_location='cpu') if args.checkpoint else None
+
+  chosen = rng.choice(len(utt_vectors), args.num_queries)
+  scale = args.noise * np.linalg.norm(utt_vectors, axis=1).mean() / np.sqrt(utt_vectors.shape[1])
+  queries = utt_vectors[chosen] + scale * rng.randn(args.num_queries, utt_vectors.shape[1])
+  bank = project(utt_vectors, state_dict, 'candidate_linear').astype(np.float32)
+  queries = project(queries, state_dict, 'context_linear').astype(np.float32)
+  print(f"Searching {len(bank)} utterances of dim {bank.shape[1]} with {len(queries)} queries")
+
+  exact = ExactIndex(bank)
+  start = time.perf_counter()
+  approximate = IVFPQIndex(bank, num_lists=args.num_lists, num_subspaces=args.pq_subspaces,
+                              rerank=args.rerank, seed=args.seed)
+  print(f"Built IVF-PQ index with {approximate.num_lists} lists in {time.perf_counter() - start:.1f}s")
+
+  for k in args.top_k:
+    expected, exact_ms = timed_search(exact, queries, k)
+    print(f"k={k:<3} brute force       recall 1.000  {exact_ms:.3f} ms/query")
+    for num_probe in args.num_probe:
+      found, approx_ms = timed_search(approximate, queries, k, num_probe=num_probe)
+      recall = recall_at_k(found, expected)
+      print(f"k={k:<3} ivfpq probe={num_probe:<4} recall {recall:.3f}  {approx_ms:.3f} ms/query")
@@ -0,0 +1,39 @@
+""" Serves a trained CDS model to many concurrent conversations, coalescing their turns into
+micro batches.  Takes the same options as main.py to find the checkpoint, for example:
+  PYTHONPATH=. python utils/serve.py --task cds --model-type bert --prefix 0524 --filename final
+Then POST {"session_id": "abc", "text": "hi, i need to return a shirt"} to /turn, or GET /stats
+for latency percentiles and the histogram of batch sizes. """
+
+import os, sys, pdb
+import asyncio
+
+from utils.arguments import solicit_params
+from utils.help import set_seed, setup_gpus, check_directories, device
+from utils.load import load_tokenizer, load_candidates
+from utils.process import CDSProcessor
+from components.models import CascadeDialogSuccess
+from components.systems import Application
+from components.serving import SessionStore, MicroBatcher, ChatServer
+
+def load_application(args, target=device):
+  ckpt_dir, _ = check_directories(args)
+  tokenizer, ontology = load_tokenizer(args)
+  processor = CDSProcessor(args, tokenizer, ontology)
+  model = CascadeDialogSuccess.from_pretrained(args, processor.mappers, ckpt_dir, len(tokenizer))
+  model = model.to(target)
+  model.add_candidate_data(*load_candidates(args))
+  return Application(args, model, processor)
+
+if __name__ == "__main__":
+  args = solicit_params()
+  args = setup_gpus(args)
+  set_seed(args)
+  if args.task != 'cds':
+    raise ValueError("Only cds models decide what to say next, so serving requires --task cds")
+
+  app = load_application(args)
+  sessions = SessionStore(app.processor, args.max_sessions, args.session_ttl)
+  batcher = MicroBatcher(app, sessions, args.serve_batch_size, args.batch_deadline / 1000)
+  server = ChatServer(batcher)
+  asyncio.run(server.serve(args.host, args.port, args.socket_path, args.session_snapshot,
+                              args.snapshot_interval))